@@ -0,0 +1,51 @@
+from os import sys, path
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+import json
+import multiprocessing
+import time
+
+import requests
+
+from geotrigger.receiver import CallbackReceiver
+
+CALLBACKS = 20000
+CLIENTS = 8
+
+
+def client(url, n):
+    # Each client process POSTs its share of distinct callbacks over a single
+    # keep-alive connection.
+    http = requests.Session()
+    for i in range(n, CALLBACKS, CLIENTS):
+        http.post(url, data=json.dumps({
+            'trigger': {'triggerId': 'trigger%d' % i},
+            'device': {'deviceId': 'device%d' % (i % 1000)},
+            'location': {'timestamp': '2014-01-01T00:00:00Z'}
+        }), headers={'Content-Type': 'application/json'})
+
+
+def callback_benchmark():
+    # Start a receiver on a free local port, deduplicating recent callbacks.
+    receiver = CallbackReceiver(host='127.0.0.1', port=0, dedupe=100000)
+    receiver.handler(lambda callback: None)
+    receiver.start()
+    url = 'http://127.0.0.1:%d/' % receiver.port
+
+    print 'Sending %d callbacks from %d clients...' % (CALLBACKS, CLIENTS)
+    start = time.time()
+    clients = [multiprocessing.Process(target=client, args=(url, n))
+               for n in range(CLIENTS)]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    receiver.shutdown()
+    elapsed = time.time() - start
+
+    print '%.0f callbacks/sec' % (CALLBACKS / elapsed)
+    print receiver.stats()
+
+
+if __name__ == '__main__':
+    callback_benchmark()
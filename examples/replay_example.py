@@ -0,0 +1,25 @@
+from os import sys, path
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+from geotrigger.replay import Replay, load_traces
+
+CLIENT_ID = 'YOUR_CLIENT_ID'
+
+
+def replay_example():
+    # Load recorded vehicle traces. Each trace will be replayed by its own
+    # freshly registered device.
+    traces = load_traces(sys.argv[1:])
+    print 'Loaded %d traces.' % len(traces)
+
+    # Replay the traces ten times faster than they were recorded, using one
+    # worker process per CPU.
+    replay = Replay(CLIENT_ID, traces, speed=10)
+    report = replay.run()
+
+    # Print the achieved throughput, latency and lag behind schedule.
+    print report
+
+
+if __name__ == '__main__':
+    replay_example()
@@ -26,7 +26,9 @@ Basic usage:
 """
 
 from client import GeotriggerClient
-from session import GeotriggerDevice, GeotriggerApplication, GeotriggerException
+from models import Trigger, Device, Tag, LocationBatch
+from session import GeotriggerDevice, GeotriggerApplication, \
+    GeotriggerException, GeotriggerTimeout
 from version import VERSION
 
 __version__ = VERSION
@@ -34,4 +36,5 @@ __version__ = VERSION
 __author__ = 'Josh Yaganeh <jyaganeh@esri.com>'
 
 __all__ = [GeotriggerClient, GeotriggerDevice, GeotriggerApplication,
-           GeotriggerException]
\ No newline at end of file
+           GeotriggerException, GeotriggerTimeout, Trigger, Device, Tag,
+           LocationBatch]
\ No newline at end of file
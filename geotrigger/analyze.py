@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+import json
+from math import acos, asin, ceil, cos, floor, log, pi, radians, sin, sqrt
+
+from models import Trigger
+from session import log as debug_log
+
+EARTH_RADIUS = 6371008.8
+
+# Centers and radii closer than this many meters are considered equal.
+DUPLICATE_TOLERANCE = 1.0
+
+# Fraction of the smaller fence that must be covered to report an overlap.
+OVERLAP_THRESHOLD = 0.8
+
+# Maximum number of ids sent in a single 'trigger/delete' request.
+MAX_IDS = 500
+
+
+class Finding(object):
+    """
+    A consolidation candidate: triggers in `redundant` that duplicate, are
+    contained in or mostly overlap the trigger `keep`, with the same action,
+    direction, tags and properties. `overlap` is the fraction of the smaller
+    fence covered by the larger one.
+    """
+
+    def __init__(self, kind, keep, redundant, overlap=1.0):
+        self.kind = kind
+        self.keep = keep
+        self.redundant = redundant
+        self.overlap = overlap
+
+    def __str__(self):
+        return '{}: keep {}, redundant {} ({:.0%} overlap)'.format(
+            self.kind, self.keep, ', '.join(self.redundant), self.overlap)
+
+
+class AnalysisReport(object):
+    """
+    The findings of a `TriggerAnalyzer`, and the number of circular triggers
+    that were compared.
+    """
+
+    def __init__(self, findings, analyzed):
+        self.findings = findings
+        self.analyzed = analyzed
+
+    def of_kind(self, *kinds):
+        return [f for f in self.findings if f.kind in kinds]
+
+    def delete_ids(self, kinds=('duplicate',)):
+        """
+        Returns the ids of the redundant triggers of the given kinds of
+        finding. Only exact duplicates are included by default.
+        """
+        ids = set()
+        for finding in self.of_kind(*kinds):
+            ids.update(finding.redundant)
+        return sorted(ids)
+
+    def apply(self, client, kinds=('duplicate',)):
+        """
+        Deletes the redundant triggers of the given kinds of finding with bulk
+        'trigger/delete' requests, and returns the deleted ids.
+        """
+        ids = self.delete_ids(kinds)
+        for i in range(0, len(ids), MAX_IDS):
+            client.request('trigger/delete', {'triggerIds': ids[i:i + MAX_IDS]})
+        return ids
+
+    def __str__(self):
+        lines = ['Analyzed {} circular triggers: {} duplicate, {} contained, '
+                 '{} overlapping.'.format(
+                     self.analyzed, len(self.of_kind('duplicate')),
+                     len(self.of_kind('contained')),
+                     len(self.of_kind('overlap')))]
+        lines.extend(str(f) for f in self.findings)
+        return '\n'.join(lines)
+
+
+class TriggerAnalyzer(object):
+    """
+    Finds circular triggers that are exact duplicates of each other, fully
+    contained in another, or mostly overlapping another, among triggers with
+    the same action, direction, tags and properties.
+
+    Fences are indexed in grids of cells scaled to their radius, so each fence
+    is only compared with nearby fences and the analysis runs in roughly
+    linear time for realistic trigger sets.
+
+        >>> report = TriggerAnalyzer(gt).analyze()
+        >>> print report
+        >>> report.apply(gt)
+    """
+
+    def __init__(self, client=None, tolerance=DUPLICATE_TOLERANCE,
+                 threshold=OVERLAP_THRESHOLD):
+        self.client = client
+        self.tolerance = tolerance
+        self.threshold = threshold
+
+    def fetch(self):
+        """
+        Fetches every trigger of the application as `Trigger` objects.
+        """
+        return [Trigger.from_json(t)
+                for t in self.client.request_stream('trigger/list', 'triggers')]
+
+    def analyze(self, triggers=None):
+        """
+        Analyzes the given `Trigger` objects, or every trigger fetched through
+        the client, and returns an `AnalysisReport`.
+        """
+        if triggers is None:
+            triggers = self.fetch()
+
+        groups = {}
+        for trigger in triggers:
+            if trigger.is_circle():
+                groups.setdefault(_signature(trigger), []).append(trigger)
+
+        findings = []
+        for group in groups.itervalues():
+            findings.extend(self._analyze_group(group))
+        debug_log("Analyzed {} triggers in {} groups.".format(
+            sum(len(g) for g in groups.itervalues()), len(groups)))
+
+        return AnalysisReport(findings, sum(len(g) for g in groups.itervalues()))
+
+    def _analyze_group(self, triggers):
+        fences = [_Fence(t) for t in triggers]
+        parent = range(len(fences))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        # Fences whose center and radius fall in the same bucket, half the
+        # tolerance wide, are duplicates of the one with the lowest id. Only
+        # that fence of each bucket is compared with the others.
+        buckets = {}
+        for i, fence in enumerate(fences):
+            buckets.setdefault(fence.bucket(self.tolerance / 2.0), []).append(i)
+        unique = []
+        for bucket in buckets.itervalues():
+            first = min(bucket, key=lambda i: fences[i].trigger_id)
+            for i in bucket:
+                parent[i] = first
+            unique.append(first)
+        unique.sort()
+
+        pairs = []
+        for i, j, d in self._candidates([fences[i] for i in unique]):
+            i, j = unique[i], unique[j]
+            a, b = fences[i], fences[j]
+            if d <= self.tolerance and \
+                    abs(a.radius - b.radius) <= self.tolerance:
+                parent[find(i)] = find(j)
+            else:
+                pairs.append((i, j, d))
+
+        # Exact duplicates, keeping the lowest trigger id of each group.
+        members = {}
+        for i in range(len(fences)):
+            members.setdefault(find(i), []).append(fences[i].trigger_id)
+        findings = []
+        representatives = set()
+        for root, ids in members.iteritems():
+            ids.sort()
+            representatives.add(ids[0])
+            if len(ids) > 1:
+                findings.append(Finding('duplicate', ids[0], ids[1:]))
+
+        # Containment and overlap between the remaining triggers.
+        for i, j, d in pairs:
+            a, b = fences[i], fences[j]
+            if a.radius < b.radius:
+                a, b = b, a
+            if a.trigger_id not in representatives or \
+                    b.trigger_id not in representatives:
+                continue
+
+            if d + b.radius <= a.radius + self.tolerance:
+                findings.append(Finding('contained', a.trigger_id,
+                                        [b.trigger_id]))
+            elif b.radius > 0:
+                overlap = _intersection(d, a.radius, b.radius) / \
+                    (pi * b.radius ** 2)
+                if overlap >= self.threshold:
+                    findings.append(Finding('overlap', a.trigger_id,
+                                            [b.trigger_id], overlap))
+        return findings
+
+    def _candidates(self, fences):
+        """
+        Yields (i, j, distance) for every pair of fences that touch.
+        """
+        grids = {}
+        for i, fence in enumerate(fences):
+            grids.setdefault(fence.level, {}).setdefault(
+                fence.cell(fence.level), []).append(i)
+
+        # Each fence is only compared with fences of its own or larger levels,
+        # whose coarser grids need only the neighbouring cells searched.
+        for i, a in enumerate(fences):
+            for level, grid in grids.iteritems():
+                if level < a.level:
+                    continue
+
+                size = _cell_size(level)
+                reach = a.radius + 2 ** level + self.tolerance
+                k = int(ceil(reach / size))
+                cx, cy, cz = a.cell(level)
+
+                if (2 * k + 1) ** 3 > len(grid):
+                    cells = grid.itervalues()
+                else:
+                    cells = (grid.get((x, y, z), ())
+                             for x in range(cx - k, cx + k + 1)
+                             for y in range(cy - k, cy + k + 1)
+                             for z in range(cz - k, cz + k + 1))
+
+                for cell in cells:
+                    for j in cell:
+                        # Pairs within a level are found from both sides.
+                        if level == a.level and j <= i:
+                            continue
+                        b = fences[j]
+                        d = a.distance(b)
+                        if d < a.radius + b.radius + self.tolerance:
+                            yield i, j, d
+
+
+class _Fence(object):
+    """
+    A circular fence with its center in earth centered cartesian coordinates.
+    """
+
+    __slots__ = ('trigger_id', 'radius', 'level', 'x', 'y', 'z')
+
+    def __init__(self, trigger):
+        lat = radians(trigger.latitude)
+        lon = radians(trigger.longitude)
+        self.trigger_id = trigger.trigger_id
+        self.radius = float(trigger.distance)
+        self.level = max(0, int(ceil(log(max(self.radius, 1.0), 2))))
+        self.x = EARTH_RADIUS * cos(lat) * cos(lon)
+        self.y = EARTH_RADIUS * cos(lat) * sin(lon)
+        self.z = EARTH_RADIUS * sin(lat)
+
+    def bucket(self, size):
+        """
+        Returns the key of the bucket of fences whose centers and radii are
+        within `size` meters of this one on every axis.
+        """
+        if not size:
+            return self.x, self.y, self.z, self.radius
+        return (int(floor(self.x / size)), int(floor(self.y / size)),
+                int(floor(self.z / size)), int(floor(self.radius / size)))
+
+    def cell(self, level):
+        size = _cell_size(level)
+        return (int(floor(self.x / size)), int(floor(self.y / size)),
+                int(floor(self.z / size)))
+
+    def distance(self, other):
+        """
+        Returns the great circle distance in meters between the centers.
+        """
+        chord = sqrt((self.x - other.x) ** 2 + (self.y - other.y) ** 2 +
+                     (self.z - other.z) ** 2)
+        return 2 * EARTH_RADIUS * asin(min(1.0, chord / (2 * EARTH_RADIUS)))
+
+
+def _cell_size(level):
+    # Fences of a level have a radius of at most 2 ** level meters.
+    return 2.0 ** (level + 1)
+
+
+def _signature(trigger):
+    """
+    Returns the parts of a trigger that must be equal for two fences to be
+    redundant: its action, direction, properties and non default tags.
+    """
+    default = 'trigger:{}'.format(trigger.trigger_id)
+    return json.dumps([
+        trigger.direction,
+        trigger.action,
+        trigger.properties,
+        trigger.condition_extra or None,
+        sorted(t for t in trigger.tags or () if t != default)
+    ], sort_keys=True)
+
+
+def _intersection(d, r1, r2):
+    """
+    Returns the area of the intersection of two circles with radii `r1` and
+    `r2` whose centers are `d` apart.
+    """
+    if d >= r1 + r2:
+        return 0.0
+    if d <= abs(r1 - r2):
+        return pi * min(r1, r2) ** 2
+
+    a1 = r1 ** 2 * acos(_clamp((d ** 2 + r1 ** 2 - r2 ** 2) / (2 * d * r1)))
+    a2 = r2 ** 2 * acos(_clamp((d ** 2 + r2 ** 2 - r1 ** 2) / (2 * d * r2)))
+    kite = 0.5 * sqrt(max(0.0, (-d + r1 + r2) * (d + r1 - r2) *
+                          (d - r1 + r2) * (d + r1 + r2)))
+    return a1 + a2 - kite
+
+
+def _clamp(x):
+    return max(-1.0, min(1.0, x))
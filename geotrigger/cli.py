@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Command line interface to the Geotrigger API.
+
+Make a single request and print the response:
+
+    $ geotrigger trigger/list '{"tags": "downtown"}'
+
+Print each element of a large list as a line of json:
+
+    $ geotrigger --stream triggers trigger/list
+
+Or make many requests over one warm session, reading one json request per
+line from stdin and writing one json response per line to stdout, in order:
+
+    $ echo '{"route": "trigger/list", "data": {"tags": "downtown"}}' | geotrigger
+
+Credentials are read from the GEOTRIGGER_CLIENT_ID and
+GEOTRIGGER_CLIENT_SECRET environment variables or the matching options.
+Tokens, and the device registered when no client secret is given, are cached
+between runs in ~/.geotrigger/tokens.json.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from Queue import Queue
+
+from client import GeotriggerClient
+from session import GeotriggerApplication, GeotriggerDevice, \
+    GeotriggerSession
+
+TOKEN_CACHE = os.path.join('~', '.geotrigger', 'tokens.json')
+
+
+class TokenCache(object):
+    """
+    Stores the credentials of sessions in a json file readable only by the
+    current user, so that tokens and devices are reused across processes.
+    """
+
+    def __init__(self, path=TOKEN_CACHE):
+        self.path = os.path.expanduser(path)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def session(self, client_id, client_secret=None):
+        """
+        Returns a session for the given credentials, using cached tokens if
+        they are still valid.
+        """
+        key = client_id if client_secret else client_id + ':device'
+        cached = self.load().get(key)
+
+        # Application tokens are only reused while valid, an expired device
+        # token is refreshed on first use.
+        if cached and (not client_secret or
+                       (cached['expires_at'] or 0) > time.time()):
+            return GeotriggerSession.from_credentials(client_id, cached,
+                                                      client_secret)
+
+        if client_secret:
+            return GeotriggerApplication(client_id, client_secret)
+        return GeotriggerDevice(client_id)
+
+    def save(self, session):
+        """
+        Stores the current credentials of `session`.
+        """
+        key = session.client_id if session.is_application() else \
+            session.client_id + ':device'
+
+        tokens = self.load()
+        tokens[key] = session.credentials()
+
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+
+        # Write to a private temporary file, then rename over the cache so
+        # that concurrent processes never read a partial file.
+        tmp = '{}.{}'.format(self.path, os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(tokens, f)
+        os.rename(tmp, self.path)
+
+
+def pipeline(client, lines, out, concurrency=8, deadline=None):
+    """
+    Makes the request on each json line of `lines` using up to `concurrency`
+    requests at a time, writing a json response line for each to `out` in
+    input order. Returns the number of failed requests.
+
+    Each request line is an object with a 'route' and optional 'data' and
+    'id', which is copied to the response line along with either the
+    'response' or an 'error' message.
+    """
+    if concurrency < 1:
+        raise ValueError('concurrency must be at least 1.')
+
+    tasks = Queue(concurrency)
+
+    def work():
+        while True:
+            line, result = tasks.get()
+            result.put(_handle(client, line, deadline))
+
+    for i in range(concurrency):
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+
+    # Results are written in order while up to `concurrency` requests after
+    # the oldest one are in flight.
+    pending = deque()
+    errors = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        result = Queue(1)
+        tasks.put((line, result))
+        pending.append(result)
+        if len(pending) > concurrency:
+            errors += _write(out, pending.popleft().get())
+
+    while pending:
+        errors += _write(out, pending.popleft().get())
+    return errors
+
+
+def _handle(client, line, deadline):
+    response = {}
+    try:
+        request = json.loads(line)
+        if 'id' in request:
+            response['id'] = request['id']
+        response['route'] = request['route']
+        response['response'] = client.request(
+            request['route'], request.get('data', {}), deadline=deadline)
+    except Exception as e:
+        response['error'] = str(e) or e.__class__.__name__
+    return response
+
+
+def _write(out, response):
+    out.write(json.dumps(response) + '\n')
+    out.flush()
+    return 1 if 'error' in response else 0
+
+
+def _positive_int(value):
+    import argparse
+
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError('must be at least 1')
+    return number
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='geotrigger', description='Make Geotrigger API requests.')
+    parser.add_argument('route', nargs='?',
+                        help='API route, e.g. trigger/list. If omitted, '
+                             'json requests are read from stdin, one per line.')
+    parser.add_argument('data', nargs='?', default='{}',
+                        help='json request data')
+    parser.add_argument('--client-id',
+                        default=os.environ.get('GEOTRIGGER_CLIENT_ID'))
+    parser.add_argument('--client-secret',
+                        default=os.environ.get('GEOTRIGGER_CLIENT_SECRET'))
+    parser.add_argument('--stream', metavar='KEY',
+                        help='write each element of the KEY list of the '
+                             'response as a line of json')
+    parser.add_argument('--concurrency', type=_positive_int, default=8,
+                        help='requests in flight when reading from stdin')
+    parser.add_argument('--deadline', type=float,
+                        help='seconds allowed for each request, except '
+                             'with --stream')
+    parser.add_argument('--token-cache', default=TOKEN_CACHE)
+    parser.add_argument('--no-token-cache', action='store_true')
+    args = parser.parse_args(argv)
+
+    if not args.client_id:
+        parser.error('a client id is required.')
+
+    cache = None if args.no_token_cache else TokenCache(args.token_cache)
+    if cache:
+        session = cache.session(args.client_id, args.client_secret)
+        cache.save(session)
+    elif args.client_secret:
+        session = GeotriggerApplication(args.client_id, args.client_secret)
+    else:
+        session = GeotriggerDevice(args.client_id)
+    client = GeotriggerClient(session=session)
+    token = session.access_token
+
+    try:
+        if args.route and args.stream:
+            for item in client.request_stream(args.route, args.stream,
+                                              args.data):
+                sys.stdout.write(json.dumps(item) + '\n')
+            errors = 0
+        elif args.route:
+            response = client.request(args.route, args.data,
+                                      deadline=args.deadline)
+            sys.stdout.write(json.dumps(response, indent=2) + '\n')
+            errors = 0
+        else:
+            errors = pipeline(client, iter(sys.stdin.readline, ''),
+                              sys.stdout, args.concurrency, args.deadline)
+    finally:
+        if cache and session.access_token != token:
+            cache.save(session)
+
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
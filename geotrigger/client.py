@@ -42,9 +42,28 @@ class GeotriggerClient:
             raise ValueError("You must specify a client_id or session.")
 
 
-    def request(self, route, data='{}'):
+    def request(self, route, data='{}', deadline=None):
         """
         Makes a Geotrigger API request to the given `route`.
         The optional `data` parameter can be either a dict or a json string.
+
+        The optional `deadline` limits the total time, in seconds, spent on
+        the request, including any token refresh and retry. If it is exceeded
+        a `GeotriggerTimeout` is raised.
+        """
+        with self.session.deadline(deadline):
+            return self.session.geotrigger_request(route, data=data)
+
+    def request_stream(self, route, key=None, data='{}'):
+        """
+        Makes a Geotrigger API request to the given `route` and returns an
+        iterator over the elements of the `key` array of the response, such as
+        'triggers' for 'trigger/list' or 'devices' for 'device/list'.
+
+        The response is parsed incrementally as it is downloaded, so the first
+        element is available before the body has finished and very large lists
+        are iterated in constant memory. When `key` is omitted it is derived
+        from the route. The optional `data` parameter can be either a dict or a
+        json string.
         """
-        return self.session.geotrigger_request(route, data=data)
\ No newline at end of file
+        return self.session.geotrigger_stream(route, key=key, data=data)
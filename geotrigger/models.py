@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+import calendar
+import json
+import re
+import time
+from array import array
+from datetime import datetime
+from itertools import izip
+from math import floor
+
+TAG_PERMISSIONS = (
+    'deviceList',
+    'deviceLocation',
+    'deviceTagging',
+    'deviceToggleTracking',
+    'triggerApply',
+    'triggerDelete',
+    'triggerHistory',
+    'triggerList',
+    'triggerUpdate',
+)
+
+ISO_8601 = re.compile(
+    r'^(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(\.\d+)?'
+    r'(Z|[+-]\d\d:?\d\d)?$')
+
+CIRCLE_KEYS = set(['latitude', 'longitude', 'distance'])
+
+LOCATION_JSON = ('{{"timestamp":"{}","latitude":{!r},"longitude":{!r},'
+                 '"accuracy":{!r}}}')
+
+
+def to_epoch(value):
+    """
+    Converts a timestamp given as seconds since the epoch, a `datetime` or an
+    ISO 8601 string to seconds since the epoch. Timestamps without a time zone
+    are taken to be UTC.
+    """
+    if isinstance(value, (int, long, float)):
+        return float(value)
+
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            seconds = calendar.timegm(value.timetuple())
+        else:
+            seconds = calendar.timegm(value.utctimetuple())
+        return seconds + value.microsecond / 1e6
+
+    match = ISO_8601.match(value.strip())
+    if not match:
+        raise ValueError('Invalid timestamp: {}'.format(value))
+
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+    seconds = calendar.timegm((int(year), int(month), int(day), int(hour),
+                               int(minute), int(second), 0, 0, 0))
+    if fraction:
+        seconds += float(fraction)
+    if zone and zone != 'Z':
+        offset = 3600 * int(zone[1:3]) + 60 * int(zone[-2:])
+        seconds += -offset if zone[0] == '+' else offset
+    return float(seconds)
+
+
+def to_iso(seconds):
+    """
+    Formats seconds since the epoch as an ISO 8601 UTC timestamp with
+    millisecond precision.
+    """
+    whole = int(floor(seconds))
+    millis = int(round((seconds - whole) * 1000))
+    if millis == 1000:
+        whole += 1
+        millis = 0
+    return '{}.{:03d}Z'.format(
+        time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(whole)), millis)
+
+
+def _tags(value):
+    if value is None:
+        return ()
+    if isinstance(value, basestring):
+        return (value,)
+    return tuple(value)
+
+
+def _optional_tags(obj, key):
+    # Pops the tags of an API object, keeping None if it has none so that
+    # they are not added when converting back to json.
+    if key not in obj:
+        return None
+    return _tags(obj.pop(key))
+
+
+class Trigger(object):
+    """
+    A compact representation of a Geotrigger API trigger.
+
+    The circular `geo` condition used by most triggers is stored in flat
+    attributes, any other geometry is kept as given in `geo`. Members of the
+    API object that have no attribute of their own are kept in `extra` (and
+    `condition_extra` for the condition) so that conversion back to json is
+    lossless. `tags` is None if the API object had no tags.
+    """
+
+    __slots__ = ('trigger_id', 'direction', 'latitude', 'longitude',
+                 'distance', 'geo', 'action', 'tags', 'properties',
+                 'condition_extra', 'extra')
+
+    def __init__(self, trigger_id=None, direction=None, latitude=None,
+                 longitude=None, distance=None, geo=None, action=None,
+                 tags=(), properties=None, condition_extra=None, extra=None):
+        self.trigger_id = trigger_id
+        self.direction = direction
+        self.latitude = latitude
+        self.longitude = longitude
+        self.distance = distance
+        self.geo = geo
+        self.action = action
+        self.tags = _tags(tags)
+        self.properties = properties
+        self.condition_extra = condition_extra
+        self.extra = extra
+
+    def is_circle(self):
+        """
+        Returns true if this trigger's condition is a circular fence.
+        """
+        return self.distance is not None
+
+    @classmethod
+    def from_json(cls, obj):
+        """
+        Creates a `Trigger` from a trigger object returned by the Geotrigger
+        API, e.g. an element of the 'triggers' list of 'trigger/list'.
+        """
+        trigger = cls.__new__(cls)
+        extra = dict(obj)
+        has_condition = 'condition' in extra
+        condition = dict(extra.pop('condition', None) or {})
+        geo = condition.pop('geo', None)
+
+        trigger.trigger_id = extra.pop('triggerId', None)
+        trigger.direction = condition.pop('direction', None)
+        if geo is not None and set(geo) == CIRCLE_KEYS:
+            trigger.latitude = geo['latitude']
+            trigger.longitude = geo['longitude']
+            trigger.distance = geo['distance']
+            trigger.geo = None
+        else:
+            trigger.latitude = trigger.longitude = trigger.distance = None
+            trigger.geo = geo
+        trigger.action = extra.pop('action', None)
+        trigger.tags = _optional_tags(extra, 'tags')
+        trigger.properties = extra.pop('properties', None)
+        # An empty dict records a condition with only a direction and geo.
+        trigger.condition_extra = condition if has_condition else None
+        trigger.extra = extra or None
+        return trigger
+
+    def to_json(self):
+        """
+        Returns this trigger as a Geotrigger API trigger object.
+        """
+        condition = dict(self.condition_extra or {})
+        if self.direction is not None:
+            condition['direction'] = self.direction
+        if self.is_circle():
+            condition['geo'] = {
+                'latitude': self.latitude,
+                'longitude': self.longitude,
+                'distance': self.distance
+            }
+        elif self.geo is not None:
+            condition['geo'] = self.geo
+
+        obj = dict(self.extra or {})
+        if self.trigger_id is not None:
+            obj['triggerId'] = self.trigger_id
+        if condition or self.condition_extra is not None:
+            obj['condition'] = condition
+        if self.action is not None:
+            obj['action'] = self.action
+        if self.tags is not None:
+            obj['tags'] = list(self.tags)
+        if self.properties is not None:
+            obj['properties'] = self.properties
+        return obj
+
+    def __repr__(self):
+        return '<Trigger {}>'.format(self.trigger_id)
+
+
+class Device(object):
+    """
+    A compact representation of a Geotrigger API device. Members of the API
+    object that have no attribute of their own are kept in `extra`. `tags`
+    is None if the API object had no tags.
+    """
+
+    __slots__ = ('device_id', 'tags', 'properties', 'tracking_profile',
+                 'last_seen', 'extra')
+
+    def __init__(self, device_id=None, tags=(), properties=None,
+                 tracking_profile=None, last_seen=None, extra=None):
+        self.device_id = device_id
+        self.tags = _tags(tags)
+        self.properties = properties
+        self.tracking_profile = tracking_profile
+        self.last_seen = last_seen
+        self.extra = extra
+
+    @classmethod
+    def from_json(cls, obj):
+        """
+        Creates a `Device` from a device object returned by the Geotrigger API,
+        e.g. an element of the 'devices' list of 'device/list'.
+        """
+        device = cls.__new__(cls)
+        extra = dict(obj)
+        device.device_id = extra.pop('deviceId', None)
+        device.tags = _optional_tags(extra, 'tags')
+        device.properties = extra.pop('properties', None)
+        device.tracking_profile = extra.pop('trackingProfile', None)
+        device.last_seen = extra.pop('lastSeen', None)
+        device.extra = extra or None
+        return device
+
+    def to_json(self):
+        """
+        Returns this device as a Geotrigger API device object.
+        """
+        obj = dict(self.extra or {})
+        if self.device_id is not None:
+            obj['deviceId'] = self.device_id
+        if self.tags is not None:
+            obj['tags'] = list(self.tags)
+        if self.properties is not None:
+            obj['properties'] = self.properties
+        if self.tracking_profile is not None:
+            obj['trackingProfile'] = self.tracking_profile
+        if self.last_seen is not None:
+            obj['lastSeen'] = self.last_seen
+        return obj
+
+    def __repr__(self):
+        return '<Device {}>'.format(self.device_id)
+
+
+class Tag(object):
+    """
+    A compact representation of a Geotrigger API tag. The boolean permissions
+    listed in `TAG_PERMISSIONS` are stored as a bit mask.
+    """
+
+    __slots__ = ('name', 'permissions', 'extra')
+
+    def __init__(self, name, permissions=(), extra=None):
+        self.name = name
+        self.permissions = 0
+        self.extra = extra
+        for permission in permissions:
+            self.permissions |= 1 << TAG_PERMISSIONS.index(permission)
+
+    def can(self, permission):
+        """
+        Returns true if this tag grants the given `permission`, e.g.
+        'triggerList'.
+        """
+        return bool(self.permissions & 1 << TAG_PERMISSIONS.index(permission))
+
+    @classmethod
+    def from_json(cls, obj):
+        """
+        Creates a `Tag` from a tag object returned by the Geotrigger API, e.g.
+        an element of the 'tags' list of 'tag/list'.
+        """
+        tag = cls.__new__(cls)
+        extra = dict(obj)
+        tag.name = extra.pop('name', None)
+        tag.permissions = 0
+        for bit, permission in enumerate(TAG_PERMISSIONS):
+            if extra.pop(permission, False):
+                tag.permissions |= 1 << bit
+        tag.extra = extra or None
+        return tag
+
+    def to_json(self):
+        """
+        Returns this tag as a Geotrigger API tag object.
+        """
+        obj = dict(self.extra or {})
+        obj['name'] = self.name
+        for bit, permission in enumerate(TAG_PERMISSIONS):
+            obj[permission] = bool(self.permissions & 1 << bit)
+        return obj
+
+    def __repr__(self):
+        return '<Tag {}>'.format(self.name)
+
+
+class LocationBatch(object):
+    """
+    A columnar batch of location fixes for a single device, stored in typed
+    arrays of 32 bytes per fix. Timestamps are kept as seconds since the
+    epoch.
+
+    A batch serializes directly to the json payload of 'location/update':
+
+        >>> batch = LocationBatch()
+        >>> batch.append(datetime.utcnow(), 34.0562, -117.1956, 5)
+        >>> gt.request('location/update', batch.dumps())
+    """
+
+    __slots__ = ('timestamps', 'latitudes', 'longitudes', 'accuracies')
+
+    def __init__(self):
+        self.timestamps = array('d')
+        self.latitudes = array('d')
+        self.longitudes = array('d')
+        self.accuracies = array('d')
+
+    def append(self, timestamp, latitude, longitude, accuracy):
+        """
+        Adds a fix to the batch. The `timestamp` may be given as seconds since
+        the epoch, a `datetime` or an ISO 8601 string.
+        """
+        self.timestamps.append(to_epoch(timestamp))
+        self.latitudes.append(latitude)
+        self.longitudes.append(longitude)
+        self.accuracies.append(accuracy)
+
+    def extend(self, locations):
+        """
+        Adds fixes from an iterable of location objects, as found in the
+        'locations' list of a 'location/update' payload.
+        """
+        for location in locations:
+            self.append(location['timestamp'], location['latitude'],
+                        location['longitude'], location['accuracy'])
+
+    def slice(self, start=0, stop=None):
+        """
+        Returns a new batch containing the fixes from `start` to `stop`.
+        """
+        batch = LocationBatch()
+        batch.timestamps = self.timestamps[start:stop]
+        batch.latitudes = self.latitudes[start:stop]
+        batch.longitudes = self.longitudes[start:stop]
+        batch.accuracies = self.accuracies[start:stop]
+        return batch
+
+    def clear(self):
+        """
+        Removes all fixes from the batch.
+        """
+        self.__init__()
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __iter__(self):
+        """
+        Iterates over the fixes of the batch as (timestamp, latitude,
+        longitude, accuracy) tuples.
+        """
+        return izip(self.timestamps, self.latitudes, self.longitudes,
+                    self.accuracies)
+
+    @classmethod
+    def from_json(cls, payload):
+        """
+        Creates a batch from a 'location/update' payload, given as either a
+        dict or a json string.
+        """
+        if isinstance(payload, basestring):
+            payload = json.loads(payload)
+        batch = cls()
+        batch.extend(payload['locations'])
+        return batch
+
+    def to_json(self, previous=None):
+        """
+        Returns the 'location/update' payload for this batch as a dict. The
+        optional `previous` fix is given as a (timestamp, latitude, longitude,
+        accuracy) tuple.
+        """
+        return json.loads(self.dumps(previous))
+
+    def dumps(self, previous=None):
+        """
+        Serializes the 'location/update' payload for this batch to a json
+        string without building intermediate dicts. The optional `previous`
+        fix is given as a (timestamp, latitude, longitude, accuracy) tuple.
+        """
+        locations = ','.join(
+            LOCATION_JSON.format(to_iso(t), lat, lon, acc)
+            for t, lat, lon, acc in self)
+
+        if previous is None:
+            return '{"locations":[' + locations + ']}'
+
+        t, lat, lon, acc = previous
+        return '{"previous":' + LOCATION_JSON.format(
+            to_iso(to_epoch(t)), float(lat), float(lon), float(acc)) + \
+            ',"locations":[' + locations + ']}'
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import threading
+from Queue import Queue, Empty
+
+
+def parallel_map(func, items, workers):
+    """
+    Calls `func` with each of `items` from up to `workers` threads, and
+    returns the results in the order of `items`. If `func` raises an
+    exception for an item, the exception is returned as its result.
+    """
+    items = list(items)
+    queue = Queue()
+    for i, item in enumerate(items):
+        queue.put((i, item))
+    results = [None] * len(items)
+
+    def work():
+        while True:
+            try:
+                i, item = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                results[i] = func(item)
+            except Exception as e:
+                results[i] = e
+
+    threads = [threading.Thread(target=work)
+               for i in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
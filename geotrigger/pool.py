@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from client import GeotriggerClient
+from parallel import parallel_map
+from session import GeotriggerDevice, GeotriggerException, log
+
+
+class DevicePool(object):
+    """
+    A pool of registered device sessions that are leased to workers and
+    returned after use, for load tests and tools that act as many devices.
+
+    Devices are registered by `workers` threads in parallel. While a
+    background refresher is running, the tokens of idle devices are refreshed
+    before they expire, so leased devices never pay for a refresh.
+
+        >>> pool = DevicePool(CLIENT_ID)
+        >>> pool.fill(10000)
+        >>> pool.start()
+        >>> with pool.client() as gt:
+        ...     gt.request('location/update', {...})
+        >>> print pool.stats()
+
+    The credentials of the pool can be kept with `save` and reused in a later
+    run with `load`, instead of registering new devices.
+    """
+
+    def __init__(self, client_id, workers=16, refresh_margin=300):
+        self.client_id = client_id
+        self.workers = workers
+        self.refresh_margin = refresh_margin
+
+        self.devices = []
+        self.failures = []
+        self._idle = deque()
+        self._leased = set()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self.registered = 0
+        self.refreshed = 0
+        self.leases = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+        self.max_leased = 0
+
+    def __len__(self):
+        return len(self.devices)
+
+    @property
+    def leased(self):
+        return len(self._leased)
+
+    def fill(self, size):
+        """
+        Registers devices in parallel until the pool holds `size` devices, and
+        returns the number registered. Registrations that fail are listed with
+        their exception in `failures`.
+        """
+        needed = size - len(self.devices)
+        if needed <= 0:
+            return 0
+
+        def register(i):
+            device = GeotriggerDevice(self.client_id)
+            self.add(device)
+            return device
+
+        results = parallel_map(register, range(needed), self.workers)
+        failures = [r for r in results if isinstance(r, Exception)]
+        registered = needed - len(failures)
+        with self._lock:
+            self.failures.extend(failures)
+            self.registered += registered
+
+        log("Registered {} devices, {} failed.".format(
+            registered, needed - registered))
+        return registered
+
+    def add(self, device):
+        """
+        Adds a device session to the pool.
+        """
+        with self._available:
+            self.devices.append(device)
+            self._idle.append(device)
+            self._available.notify()
+
+    def lease(self, timeout=None):
+        """
+        Takes an idle device session from the pool, waiting up to `timeout`
+        seconds, or forever if None, for one to be returned. Raises a
+        `GeotriggerException` if no device becomes available in time.
+        """
+        with self._available:
+            if not self.devices:
+                raise GeotriggerException('The device pool is empty.')
+
+            if not self._idle:
+                self.waits += 1
+                start = time.time()
+                end = None if timeout is None else start + timeout
+                while not self._idle:
+                    remaining = None if end is None else end - time.time()
+                    if remaining is not None and remaining <= 0:
+                        self.timeouts += 1
+                        self.wait_time += time.time() - start
+                        raise GeotriggerException(
+                            'No device available after {} seconds.'.format(
+                                timeout))
+                    self._available.wait(remaining)
+                self.wait_time += time.time() - start
+
+            device = self._idle.popleft()
+            self._leased.add(device)
+            self.leases += 1
+            self.max_leased = max(self.max_leased, self.leased)
+            return device
+
+    def release(self, device):
+        """
+        Returns a leased device session to the pool. Raises a `ValueError`
+        if the device is not currently leased from this pool.
+        """
+        with self._available:
+            if device not in self._leased:
+                raise ValueError('The device is not leased from this pool.')
+            self._leased.remove(device)
+            self._idle.append(device)
+            self._available.notify()
+
+    @contextmanager
+    def client(self, timeout=None):
+        """
+        Leases a device for the duration of a `with` block, as a
+        `GeotriggerClient`.
+        """
+        device = self.lease(timeout)
+        try:
+            yield GeotriggerClient(session=device)
+        finally:
+            self.release(device)
+
+    def refresh_idle(self):
+        """
+        Refreshes the tokens of idle devices that expire within
+        `refresh_margin` seconds, and returns the number refreshed. Devices
+        are taken out of the pool while they are refreshed.
+        """
+        expiring = datetime.now() + timedelta(seconds=self.refresh_margin)
+        with self._lock:
+            stale = [d for d in self._idle
+                     if d.expires_at is not None and d.expires_at < expiring]
+            if stale:
+                self._refreshing.update(stale)
+                self._idle = deque(d for d in self._idle
+                                   if d not in self._refreshing)
+
+        def refresh(device):
+            try:
+                device.refresh()
+            finally:
+                with self._available:
+                    self._refreshing.remove(device)
+                    self._idle.append(device)
+                    self._available.notify()
+
+        results = parallel_map(refresh, stale, self.workers)
+        for device, result in zip(stale, results):
+            if isinstance(result, Exception):
+                log("Device {} refresh failed: {}".format(
+                    device.device_id, result))
+
+        refreshed = sum(1 for r in results if not isinstance(r, Exception))
+        with self._lock:
+            self.refreshed += refreshed
+        return refreshed
+
+    def start(self, interval=60):
+        """
+        Starts a background thread that refreshes idle devices every
+        `interval` seconds.
+        """
+        if self._thread is not None:
+            raise GeotriggerException('The pool is already refreshing.')
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the background thread started with `start`.
+        """
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, interval):
+        while not self._stopped.is_set():
+            self.refresh_idle()
+            self._stopped.wait(interval)
+
+    def stats(self):
+        """
+        Returns the pool size, usage and saturation counters. `waits` is the
+        number of leases that found no idle device, and `wait_time` the total
+        seconds spent waiting for one.
+        """
+        with self._lock:
+            size = len(self.devices)
+            return {
+                'size': size,
+                'idle': len(self._idle),
+                'leased': self.leased,
+                'refreshing': len(self._refreshing),
+                'max_leased': self.max_leased,
+                'utilization': float(self.leased) / size if size else 0.0,
+                'leases': self.leases,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'timeouts': self.timeouts,
+                'registered': self.registered,
+                'refreshed': self.refreshed,
+                'failures': len(self.failures)
+            }
+
+    def save(self, path):
+        """
+        Writes the credentials of every device in the pool to `path`, one json
+        object per line.
+        """
+        with self._lock:
+            devices = list(self.devices)
+        with open(path, 'w') as f:
+            for device in devices:
+                f.write(json.dumps(device.credentials()) + '\n')
+
+    def load(self, path):
+        """
+        Adds the devices saved with `save` to the pool, and returns the number
+        added. Expired tokens are refreshed on first use or by the background
+        refresher.
+        """
+        added = 0
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                self.add(GeotriggerDevice.from_credentials(
+                    self.client_id, json.loads(line)))
+                added += 1
+        return added
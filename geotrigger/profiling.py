@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+import heapq
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from session import _profiled
+
+# The phases of a request, in the order they happen.
+PHASES = ('serialize', 'refresh', 'headers', 'connect', 'send', 'wait',
+          'decode', 'error')
+
+
+class RequestProfile(object):
+    """
+    The time spent in each phase of a single request, and optionally the
+    memory allocated while making it.
+    """
+
+    __slots__ = ('route', 'started', 'elapsed', 'phases', 'error',
+                 'allocations', 'allocated', '_mark', '_snapshot')
+
+    def __init__(self, route):
+        self.route = route
+        self.elapsed = None
+        self.phases = {}
+        self.error = None
+        self.allocations = None
+        self.allocated = None
+        self._snapshot = None
+        self.started = self._mark = time.time()
+
+    def lap(self, phase):
+        """
+        Adds the time since the previous lap to `phase`.
+        """
+        now = time.time()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self._mark
+        self._mark = now
+
+    @contextmanager
+    def suspended(self):
+        """
+        Stops requests made within the `with` block, such as token refreshes,
+        from recording their own phases in this profile.
+        """
+        _profiled.profile = None
+        try:
+            yield
+        finally:
+            _profiled.profile = self
+
+    def __str__(self):
+        phases = '  '.join('{} {:.1f}ms'.format(p, self.phases[p] * 1000)
+                           for p in PHASES if p in self.phases)
+        line = '{:8.1f}ms {}  {}'.format(self.elapsed * 1000, self.route,
+                                         phases)
+        if self.allocations is not None:
+            line += '  ({} allocations, {:.1f} KiB)'.format(
+                self.allocations, self.allocated / 1024.0)
+        if self.error is not None:
+            line += '  error: {}'.format(self.error)
+        return line
+
+
+class Profiler(object):
+    """
+    Records where the time goes in a sample of the Geotrigger API requests
+    made by a session, broken down by phase: serializing the request data,
+    checking and refreshing the token, building headers, connecting, sending,
+    waiting for the response, decoding it and handling errors.
+
+        >>> profiler = Profiler(sample_rate=0.1)
+        >>> gt.session.profiler = profiler
+        >>> ...
+        >>> profiler.dump()
+
+    Only a `sample_rate` fraction of requests are profiled, and the `slowest`
+    of those are kept for `dump`. Connecting and sending are timed by the
+    connections of the shared pool, which costs every request a thread local
+    lookup per connection and response. If `trace_allocations` is true, the
+    number and size of memory blocks allocated during each sampled request
+    are recorded with `tracemalloc`.
+
+    Sessions without a profiler, the default, are not otherwise slowed down.
+    """
+
+    def __init__(self, sample_rate=0.01, slowest=20, trace_allocations=False):
+        if not 0 <= sample_rate <= 1:
+            raise ValueError('sample_rate must be between 0 and 1.')
+
+        self.sample_rate = sample_rate
+        self.keep = slowest
+        self.sampled = 0
+        self.failed = 0
+        self.totals = dict((phase, 0.0) for phase in PHASES)
+        self.elapsed = 0.0
+
+        self._slowest = []
+        self._lock = threading.Lock()
+
+        self.tracemalloc = None
+        if trace_allocations:
+            try:
+                import tracemalloc
+            except ImportError:
+                raise ImportError('Allocation tracing requires the tracemalloc '
+                                  'module (Python 3.4+ or pytracemalloc).')
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self.tracemalloc = tracemalloc
+
+    def current(self):
+        """
+        Returns the profile of the sampled request being made by the calling
+        thread, or None.
+        """
+        return getattr(_profiled, 'profile', None)
+
+    def start(self, route):
+        """
+        Starts profiling a request to `route` made by the calling thread, if
+        it is sampled. Returns the `RequestProfile` or None.
+        """
+        if random.random() >= self.sample_rate:
+            return None
+
+        profile = RequestProfile(route)
+        if self.tracemalloc is not None:
+            profile._snapshot = self.tracemalloc.take_snapshot()
+            profile.started = profile._mark = time.time()
+        _profiled.profile = profile
+        return profile
+
+    def stop(self, profile):
+        """
+        Finishes a profile returned by `start` and records it.
+        """
+        profile.lap('error' if profile.error is not None else 'decode')
+        _profiled.profile = None
+        profile.elapsed = profile._mark - profile.started
+
+        if profile._snapshot is not None:
+            diff = self.tracemalloc.take_snapshot().compare_to(
+                profile._snapshot, 'lineno')
+            profile._snapshot = None
+            profile.allocations = sum(s.count_diff for s in diff
+                                      if s.count_diff > 0)
+            profile.allocated = sum(s.size_diff for s in diff
+                                    if s.size_diff > 0)
+
+        with self._lock:
+            self.sampled += 1
+            if profile.error is not None:
+                self.failed += 1
+            self.elapsed += profile.elapsed
+            for phase, seconds in profile.phases.iteritems():
+                self.totals[phase] += seconds
+
+            # A heap of the slowest profiles, fastest first.
+            item = (profile.elapsed, self.sampled, profile)
+            if len(self._slowest) < self.keep:
+                heapq.heappush(self._slowest, item)
+            elif item > self._slowest[0]:
+                heapq.heapreplace(self._slowest, item)
+
+    def slowest(self, n=None):
+        """
+        Returns up to `n` of the slowest sampled requests, slowest first.
+        """
+        with self._lock:
+            profiles = [p for e, i, p in sorted(self._slowest, reverse=True)]
+        return profiles[:n] if n is not None else profiles
+
+    def summary(self):
+        """
+        Returns the total and mean seconds spent in each phase by the sampled
+        requests.
+        """
+        with self._lock:
+            return dict((phase, {
+                'total': self.totals[phase],
+                'mean': self.totals[phase] / self.sampled
+                if self.sampled else 0.0
+            }) for phase in PHASES)
+
+    def dump(self, n=None, out=None):
+        """
+        Writes the time spent in each phase by the sampled requests, and the
+        breakdown of the `n` slowest requests, to `out` or stdout.
+        """
+        out = out or sys.stdout
+        summary = self.summary()
+        out.write('Sampled {} requests ({} failed), {:.1f}ms total.\n'.format(
+            self.sampled, self.failed, self.elapsed * 1000))
+        for phase in PHASES:
+            total = summary[phase]['total']
+            out.write('  {:<10} {:10.1f}ms {:8.2f}ms mean {:6.1%}\n'.format(
+                phase, total * 1000, summary[phase]['mean'] * 1000,
+                total / self.elapsed if self.elapsed else 0.0))
+
+        slowest = self.slowest(n)
+        if slowest:
+            out.write('Slowest requests:\n')
+            for profile in slowest:
+                out.write('  {}\n'.format(profile))
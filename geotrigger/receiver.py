@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import OrderedDict
+from Queue import Queue, Full
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qsl
+
+from session import log
+
+# Seconds a callback sender is asked to wait before redelivering a callback
+# that was rejected because the queue was full.
+RETRY_AFTER = 1
+
+
+class CallbackReceiver(object):
+    """
+    An HTTP server that receives the callbacks POSTed by triggers with a
+    `callbackUrl` action, and dispatches them to registered handlers.
+
+    Callbacks are parsed by the server threads and put on a bounded queue of
+    `queue_size` callbacks, which `workers` threads pass to every handler in
+    turn. When the queue is full the server answers 503 with a Retry-After
+    header, so that the Geotrigger service redelivers the callback later
+    instead of the receiver buffering without limit.
+
+    If `dedupe` is given, the keys of that many recent callbacks are
+    remembered and redelivered callbacks are acknowledged without being
+    dispatched again.
+
+        >>> receiver = CallbackReceiver(port=8080)
+        >>> @receiver.handler
+        ... def entered(callback):
+        ...     print callback['trigger']['triggerId']
+        >>> receiver.serve_forever()
+    """
+
+    def __init__(self, host='', port=8080, path=None, workers=4,
+                 queue_size=1000, dedupe=0):
+        self.path = path
+        self.dedupe = dedupe
+        self.handlers = []
+        self.queue = Queue(queue_size)
+
+        self.received = 0
+        self.dispatched = 0
+        self.rejected = 0
+        self.duplicates = 0
+        self.errors = 0
+
+        self._lock = threading.Lock()
+        self._seen = OrderedDict()
+        self._workers = [threading.Thread(target=self._work)
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+        self.server = _Server((host, port), _CallbackRequestHandler)
+        self.server.receiver = self
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def handler(self, func):
+        """
+        Registers `func` to be called with every callback payload. Can be used
+        as a decorator.
+        """
+        self.handlers.append(func)
+        return func
+
+    def serve_forever(self):
+        """
+        Serves callbacks until `shutdown` is called.
+        """
+        self.server.serve_forever()
+
+    def start(self):
+        """
+        Serves callbacks from a background thread.
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def shutdown(self, wait=True):
+        """
+        Stops accepting callbacks and, if `wait` is true, waits until every
+        queued callback has been dispatched.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        if wait:
+            self.queue.join()
+
+    def stats(self):
+        """
+        Returns the callback counters and the current queue length.
+        """
+        return {
+            'received': self.received,
+            'dispatched': self.dispatched,
+            'rejected': self.rejected,
+            'duplicates': self.duplicates,
+            'errors': self.errors,
+            'queued': self.queue.qsize()
+        }
+
+    def receive(self, body, content_type=None):
+        """
+        Parses and enqueues a callback body, returning the HTTP status to
+        answer with.
+        """
+        try:
+            callback = parse_callback(body, content_type)
+        except ValueError as e:
+            log("Invalid callback: {}".format(e))
+            return 400
+
+        with self._lock:
+            self.received += 1
+            if self.dedupe:
+                key = callback_key(callback, body)
+                if key in self._seen:
+                    self.duplicates += 1
+                    return 200
+                self._seen[key] = True
+                if len(self._seen) > self.dedupe:
+                    self._seen.popitem(last=False)
+
+        try:
+            self.queue.put_nowait(callback)
+        except Full:
+            with self._lock:
+                self.rejected += 1
+                # Forget the callback so that its redelivery is accepted.
+                if self.dedupe:
+                    self._seen.pop(key, None)
+            return 503
+        return 200
+
+    def _work(self):
+        while True:
+            callback = self.queue.get()
+            try:
+                for handler in self.handlers:
+                    handler(callback)
+            except Exception as e:
+                log("Callback handler failed: {}".format(e))
+                with self._lock:
+                    self.errors += 1
+            else:
+                with self._lock:
+                    self.dispatched += 1
+            finally:
+                self.queue.task_done()
+
+
+def parse_callback(body, content_type=None):
+    """
+    Parses a callback body, sent either as json or as form fields whose values
+    may themselves be json.
+    """
+    if content_type and \
+            content_type.startswith('application/x-www-form-urlencoded'):
+        callback = {}
+        for name, value in parse_qsl(body, keep_blank_values=True):
+            try:
+                callback[name] = json.loads(value)
+            except ValueError:
+                callback[name] = value
+        return callback
+
+    callback = json.loads(body)
+    if not isinstance(callback, dict):
+        raise ValueError('Callback payload is not an object.')
+    return callback
+
+
+def callback_key(callback, body):
+    """
+    Returns a key identifying a callback across redeliveries: the trigger,
+    device and location timestamp when available, or else a hash of the body.
+    """
+    try:
+        return (callback['trigger']['triggerId'],
+                callback['device']['deviceId'],
+                callback['location']['timestamp'])
+    except (KeyError, TypeError):
+        return hashlib.sha1(body).hexdigest()
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class _CallbackRequestHandler(BaseHTTPRequestHandler):
+    # Allow callback senders to keep connections alive, and send each
+    # response in a single segment rather than a write per header.
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        receiver = self.server.receiver
+        length = int(self.headers.getheader('Content-Length') or 0)
+        body = self.rfile.read(length)
+
+        if receiver.path and self.path.split('?')[0] != receiver.path:
+            status = 404
+        else:
+            status = receiver.receive(body,
+                                      self.headers.getheader('Content-Type'))
+
+        self.send_response(status)
+        if status == 503:
+            self.send_header('Retry-After', str(RETRY_AFTER))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        log(format % args)
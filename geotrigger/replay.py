@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+import csv
+import json
+import multiprocessing
+import os
+import time
+from Queue import Empty
+from array import array
+from xml.etree import cElementTree
+
+from models import LocationBatch, to_epoch
+from parallel import parallel_map
+from session import GeotriggerDevice, GeotriggerException, log
+from stats import percentile
+
+LOCATION_UPDATE_ROUTE = 'location/update'
+
+DEFAULT_ACCURACY = 10
+
+# Seconds between the last worker becoming ready and the first scheduled fix.
+START_DELAY = 1.0
+
+PERCENTILES = (50, 90, 99)
+
+# Seconds between checks that the worker processes are still running.
+POLL_INTERVAL = 0.5
+
+
+def load_traces(paths):
+    """
+    Reads recorded traces from GPX, CSV or NDJSON files and returns a dict
+    mapping a device key to a time ordered list of (timestamp, latitude,
+    longitude, accuracy) fixes.
+
+    CSV files need a header row, and CSV rows and NDJSON objects need
+    'device_id' (or 'deviceId'), 'timestamp', 'latitude' and 'longitude'
+    fields, with an optional 'accuracy'. Each track of a GPX file is a device
+    keyed by the track name, or by the file name for unnamed tracks.
+    """
+    traces = {}
+    for path in paths:
+        ext = os.path.splitext(path)[1].lower()
+        if ext == '.gpx':
+            fixes = _read_gpx(path)
+        elif ext == '.csv':
+            with open(path, 'rb') as f:
+                fixes = [_read_record(row) for row in csv.DictReader(f)]
+        elif ext in ('.ndjson', '.jsonl', '.json'):
+            with open(path) as f:
+                fixes = [_read_record(json.loads(line))
+                         for line in f if line.strip()]
+        else:
+            raise ValueError('Unknown trace format: {}'.format(path))
+
+        for key, fix in fixes:
+            traces.setdefault(key, []).append(fix)
+
+    for fixes in traces.itervalues():
+        fixes.sort()
+    return traces
+
+
+def _read_record(record):
+    key = record.get('device_id') or record.get('deviceId')
+    if not key:
+        raise ValueError('Trace record has no device id: {}'.format(record))
+    return key, (to_epoch(_number(record['timestamp'])),
+                 float(record['latitude']),
+                 float(record['longitude']),
+                 float(record.get('accuracy') or DEFAULT_ACCURACY))
+
+
+def _number(value):
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def _read_gpx(path):
+    fixes = []
+    default_key = os.path.splitext(os.path.basename(path))[0]
+    for track in _children(cElementTree.parse(path).getroot(), 'trk'):
+        names = _children(track, 'name')
+        key = names[0].text.strip() if names else default_key
+        for segment in _children(track, 'trkseg'):
+            for point in _children(segment, 'trkpt'):
+                times = _children(point, 'time')
+                if not times:
+                    continue
+                fixes.append((key, (to_epoch(times[0].text),
+                                    float(point.get('lat')),
+                                    float(point.get('lon')),
+                                    DEFAULT_ACCURACY)))
+    return fixes
+
+
+def _children(element, tag):
+    # GPX 1.0 and 1.1 use different namespaces, match on the local name only.
+    return [child for child in element
+            if child.tag == tag or child.tag.endswith('}' + tag)]
+
+
+class ReplayReport(object):
+    """
+    The outcome of a replay: the number of location updates sent and failed,
+    the achieved update rate, and the request latency and lag behind schedule
+    of every update, in seconds.
+    """
+
+    def __init__(self, sent, errors, duration, latencies, lags):
+        self.sent = sent
+        self.errors = errors
+        self.duration = duration
+        self.latencies = latencies
+        self.lags = lags
+
+    @property
+    def updates_per_second(self):
+        return self.sent / self.duration if self.duration else 0.0
+
+    def latency(self, p):
+        """
+        Returns the `p`th percentile request latency in seconds.
+        """
+        return percentile(self.latencies, p)
+
+    def lag(self, p):
+        """
+        Returns the `p`th percentile lag behind schedule in seconds.
+        """
+        return percentile(self.lags, p)
+
+    def __str__(self):
+        lines = [
+            'Sent {} location updates ({} errors) in {:.1f}s, {:.1f} '
+            'updates/sec.'.format(self.sent, self.errors, self.duration,
+                                  self.updates_per_second)
+        ]
+        for name, values in (('Latency', self.latencies), ('Lag', self.lags)):
+            if len(values):
+                lines.append('{}: {}, max {:.3f}s'.format(name, ', '.join(
+                    'p{} {:.3f}s'.format(p, percentile(values, p))
+                    for p in PERCENTILES), max(values)))
+        return '\n'.join(lines)
+
+
+class Replay(object):
+    """
+    Replays recorded traces as location updates from a fleet of devices.
+
+    A device is registered for every trace, and the traces are sharded across
+    `processes` worker processes (one per CPU by default), each of which sends
+    updates from `threads` threads. Fixes are sent at their recorded time
+    relative to the earliest fix of all traces, divided by `speed`, so a speed
+    of 10 replays ten times faster than real time and a speed of None sends
+    every update as fast as possible.
+
+        >>> traces = load_traces(['vehicles.csv'])
+        >>> print Replay(CLIENT_ID, traces, speed=10).run()
+    """
+
+    def __init__(self, client_id, traces, processes=None, threads=8,
+                 speed=1.0):
+        if not traces:
+            raise ValueError('traces cannot be empty.')
+
+        self.client_id = client_id
+        self.traces = traces
+        self.processes = min(processes or multiprocessing.cpu_count(),
+                             len(traces))
+        self.threads = threads
+        self.speed = speed
+
+    def run(self):
+        """
+        Registers the devices, replays every trace and returns a
+        `ReplayReport` once all updates have been sent.
+        """
+        origin = min(fixes[0][0] for fixes in self.traces.itervalues()
+                     if fixes)
+        shards = [[] for i in range(self.processes)]
+        for i, key in enumerate(sorted(self.traces)):
+            shards[i % self.processes].append((key, self.traces[key]))
+
+        ready = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        go = multiprocessing.Event()
+        start = multiprocessing.Value('d', 0.0)
+
+        workers = [
+            multiprocessing.Process(target=_replay_shard, args=(
+                self.client_id, shard, origin, self.speed, self.threads,
+                ready, go, start, results))
+            for shard in shards
+        ]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        try:
+            # Wait until every worker has registered its devices.
+            for worker in workers:
+                error = _receive(ready, workers)
+                if error:
+                    raise GeotriggerException(
+                        'Could not register devices: {}'.format(error))
+
+            start.value = time.time() + (START_DELAY if self.speed else 0)
+            go.set()
+            log("Replaying {} traces in {} processes.".format(
+                len(self.traces), len(workers)))
+
+            sent = errors = 0
+            latencies = array('d')
+            lags = array('d')
+            for worker in workers:
+                error, result = _receive(results, workers)
+                if error:
+                    raise GeotriggerException(
+                        'Replay worker failed: {}'.format(error))
+                s, e, l, g = result
+                sent += s
+                errors += e
+                latencies.extend(l)
+                lags.extend(g)
+            duration = time.time() - start.value
+        except BaseException:
+            for worker in workers:
+                worker.terminate()
+            raise
+        finally:
+            for worker in workers:
+                worker.join()
+
+        return ReplayReport(sent, errors, duration, latencies, lags)
+
+
+def _receive(queue, workers):
+    """
+    Returns the next message from the `workers` on `queue`, raising a
+    `GeotriggerException` if they exit without sending one.
+    """
+    while True:
+        try:
+            return queue.get(timeout=POLL_INTERVAL)
+        except Empty:
+            pass
+
+        exited = [w for w in workers if not w.is_alive()]
+        for worker in exited:
+            if worker.exitcode:
+                raise GeotriggerException(
+                    'Replay worker exited with code {}.'.format(
+                        worker.exitcode))
+        if len(exited) == len(workers):
+            # Messages are flushed before a worker exits.
+            try:
+                return queue.get(timeout=POLL_INTERVAL)
+            except Empty:
+                raise GeotriggerException(
+                    'Replay workers exited without reporting.')
+
+
+def _replay_shard(client_id, shard, origin, speed, threads, ready, go, start,
+                  results):
+    """
+    Runs in a worker process, replaying the traces of one shard. Sends None
+    or a registration error on `ready`, then an (error, result) pair on
+    `results`.
+    """
+    # The queue still owed a message if the shard fails.
+    pending = ready
+    try:
+        count = min(threads, len(shard))
+        parts = [shard[i::count] for i in range(count)]
+        sessions = {}
+
+        def register(part):
+            for key, fixes in part:
+                sessions[key] = GeotriggerDevice(client_id)
+
+        errors = [r for r in parallel_map(register, parts, len(parts))
+                  if isinstance(r, Exception)]
+        pending = None
+        ready.put(str(errors[0]) if errors else None)
+        if errors:
+            return
+        pending = results
+
+        go.wait()
+
+        def replay(part):
+            stat = [0, 0, array('d'), array('d')]
+            events = sorted((fix, key) for key, fixes in part for fix in fixes)
+            previous = {}
+            for fix, key in events:
+                due = start.value + (fix[0] - origin) / speed if speed \
+                    else None
+                if due is not None:
+                    delay = due - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+
+                sent_at = time.time()
+                try:
+                    batch = LocationBatch()
+                    batch.append(*fix)
+                    payload = batch.dumps(previous.get(key))
+                    previous[key] = fix
+                    sessions[key].geotrigger_request(LOCATION_UPDATE_ROUTE,
+                                                     payload)
+                except Exception as e:
+                    log("Location update for {} failed: {}".format(key, e))
+                    stat[1] += 1
+                    continue
+
+                stat[0] += 1
+                stat[2].append(time.time() - sent_at)
+                stat[3].append(sent_at - due if due is not None else 0.0)
+            return stat
+
+        stats = parallel_map(replay, parts, len(parts))
+        for stat in stats:
+            if isinstance(stat, Exception):
+                raise stat
+
+        latencies = array('d')
+        lags = array('d')
+        for stat in stats:
+            latencies.extend(stat[2])
+            lags.extend(stat[3])
+        pending = None
+        results.put((None, (sum(s[0] for s in stats),
+                            sum(s[1] for s in stats), latencies, lags)))
+    except Exception as e:
+        error = str(e) or e.__class__.__name__
+        if pending is ready:
+            ready.put(error)
+        elif pending is results:
+            results.put((error, None))
@@ -1,9 +1,17 @@
 # -*- coding: utf-8 -*-
+import codecs
 import json
+import os
+import socket
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from Queue import Queue, Empty
 
-import requests
-
+from stats import percentile
+from stream import iter_array
 from version import VERSION, DEBUG
 
 
@@ -17,16 +25,142 @@ STATUS_TOKEN_EXPIRED = 498
 
 EXPIRES_IN_PADDING = 30
 
+STREAM_CHUNK_SIZE = 16 * 1024
+
+# Default seconds to wait for a connection and between bytes of a response.
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 30
+
+# Read only routes that are safe to send twice when hedging.
+HEDGE_ROUTES = frozenset([
+    'application/permissions',
+    'device/list',
+    'location/last',
+    'tag/list',
+    'trigger/history',
+    'trigger/list',
+])
+
+# Number of recent latencies kept per route, and the number needed before a
+# route is hedged.
+HEDGE_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+
+# Maximum number of connections kept open to each host.
+HTTP_POOL_SIZE = 32
+
+# requests is imported on first use, so that short lived command line tools
+# that import geotrigger start quickly.
+requests = None
+_http = None
+_http_pid = None
+_http_lock = threading.Lock()
+
+# The `geotrigger.profiling.RequestProfile` of the sampled request being made
+# by each thread, if any.
+_profiled = threading.local()
+
 
 class GeotriggerException(Exception):
     pass
 
 
+class GeotriggerTimeout(GeotriggerException):
+    pass
+
+
+class _TokenExpired(Exception):
+    pass
+
+
 def log(msg):
     if DEBUG:
         print(msg + "\n")
 
 
+def _lap(phase):
+    profile = getattr(_profiled, 'profile', None)
+    if profile is not None:
+        profile.lap(phase)
+
+
+def http():
+    """
+    Returns the `requests.Session` shared by every Geotrigger session, so that
+    connections are pooled and kept alive across requests and sessions. Its
+    connections record the time spent connecting and sending in the profile
+    of the current request, if it is sampled.
+
+    A forked process gets a new session, rather than sharing the sockets of
+    the connections its parent kept alive.
+    """
+    global requests, _http, _http_pid
+    pid = os.getpid()
+    if _http is None or _http_pid != pid:
+        with _http_lock:
+            if _http is None or _http_pid != pid:
+                if requests is None:
+                    import requests
+                session = requests.Session()
+                adapter = _timed_adapter()(pool_connections=HTTP_POOL_SIZE,
+                                           pool_maxsize=HTTP_POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _http = session
+                _http_pid = pid
+    return _http
+
+
+def _timed_adapter():
+    """
+    Returns a `requests` adapter class whose connections lap the 'connect'
+    and 'send' phases of sampled requests.
+    """
+    from requests.adapters import HTTPAdapter
+    from requests.packages.urllib3 import connectionpool
+
+    def timed(cls):
+        class TimedConnection(cls):
+            def connect(self):
+                _lap('send')
+                cls.connect(self)
+                _lap('connect')
+
+            def getresponse(self, *args, **kwargs):
+                _lap('send')
+                return cls.getresponse(self, *args, **kwargs)
+        return TimedConnection
+
+    class TimedHTTPConnectionPool(connectionpool.HTTPConnectionPool):
+        ConnectionCls = timed(connectionpool.HTTPConnectionPool.ConnectionCls)
+
+    class TimedHTTPSConnectionPool(connectionpool.HTTPSConnectionPool):
+        ConnectionCls = timed(connectionpool.HTTPSConnectionPool.ConnectionCls)
+
+    class TimedAdapter(HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = {
+                'http': TimedHTTPConnectionPool,
+                'https': TimedHTTPSConnectionPool
+            }
+
+    return TimedAdapter
+
+
+def _response_socket(res):
+    """
+    Returns the socket a streamed `requests` response is read from, or None.
+    """
+    # The connection gives up its socket to responses that close it.
+    sock = getattr(getattr(res.raw, '_connection', None), 'sock', None)
+    if sock is None:
+        fp = getattr(getattr(res.raw, '_fp', None), 'fp', None)
+        sock = getattr(fp, '_sock', None) or \
+            getattr(getattr(fp, 'raw', None), '_sock', None)
+    return sock
+
+
 class GeotriggerSession(object):
     """
     A base class for Geotrigger Sessions. A Session can be authorized as either
@@ -54,6 +188,36 @@ class GeotriggerSession(object):
         self.set_expires(expires_in)
         self.device_id = device_id
 
+        # Timeouts in seconds for every HTTP request, None to wait forever.
+        self.connect_timeout = CONNECT_TIMEOUT
+        self.read_timeout = READ_TIMEOUT
+
+        # Percentile of recent latency after which requests to `HEDGE_ROUTES`
+        # are sent a second time, None to disable hedging.
+        self.hedge_percentile = None
+
+        # A `geotrigger.profiling.Profiler` that records where the time goes
+        # in a sample of requests, None to disable profiling.
+        self.profiler = None
+
+        self._local = threading.local()
+        self._latencies = {}
+
+    def __getstate__(self):
+        """
+        Pickles the credentials and settings of the session. The deadlines,
+        recent latencies and profiler of this process are left out.
+        """
+        state = self.__dict__.copy()
+        del state['_local'], state['_latencies']
+        state['profiler'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._latencies = {}
+
     def set_expires(self, expires_in):
         if expires_in is None:
             expires_at = None
@@ -64,6 +228,41 @@ class GeotriggerSession(object):
         self.expires_in = expires_in
         self.expires_at = expires_at
 
+    def credentials(self):
+        """
+        Returns the tokens of this session as a json serializable dict, with
+        the time they expire as a unix timestamp, for `from_credentials`.
+        """
+        expires_at = None
+        if self.expires_at is not None:
+            expires_at = time.mktime(self.expires_at.timetuple())
+        return {
+            'device_id': self.device_id,
+            'access_token': self.access_token,
+            'refresh_token': self.refresh_token,
+            'expires_at': expires_at
+        }
+
+    @classmethod
+    def from_credentials(cls, client_id, credentials, client_secret=None):
+        """
+        Returns an application session if a `client_secret` is given, or else
+        a device session, using tokens returned by `credentials`. Expired
+        tokens are refreshed on first use.
+        """
+        expires_in = None
+        if credentials['expires_at'] is not None:
+            expires_in = max(0, credentials['expires_at'] - time.time() +
+                             EXPIRES_IN_PADDING)
+
+        if client_secret:
+            return GeotriggerApplication(client_id, client_secret,
+                                         credentials['access_token'],
+                                         expires_in)
+        return GeotriggerDevice(client_id, credentials['device_id'],
+                                credentials['access_token'],
+                                credentials['refresh_token'], expires_in)
+
     def is_device(self):
         """
         Returns true if this session is authenticated as a Device.
@@ -91,21 +290,172 @@ class GeotriggerSession(object):
         Makes a authenticated POST request to the specified `route` of the
         Geotrigger API, sending the given `data` as json.
         """
+        profile = None
+        if self.profiler is not None:
+            profile = self.profiler.start(route)
+
+        try:
+            if isinstance(data, dict):
+                data = json.dumps(data)
+            if profile is not None:
+                profile.lap('serialize')
+
+            # Refresh token if necessary
+            if datetime.now() > self.expires_at:
+                with self.unprofiled(profile):
+                    self.refresh()
+            if profile is not None:
+                profile.lap('refresh')
+
+            url = GEOTRIGGER_BASE_URL + route
+            headers = self.geotrigger_headers()
+            if profile is not None:
+                profile.lap('headers')
+
+            if self.hedge_percentile and route in HEDGE_ROUTES:
+                r = self.hedged_post(route, url, headers=headers, data=data)
+                # Hedged attempts are made by other threads, so their whole
+                # time is counted as waiting.
+                if profile is not None:
+                    profile.lap('wait')
+                return r
+            return self.post(url, headers=headers, data=data)
+        except Exception as e:
+            if profile is not None:
+                profile.error = str(e) or e.__class__.__name__
+            raise
+        finally:
+            if profile is not None:
+                self.profiler.stop(profile)
+
+    @contextmanager
+    def unprofiled(self, profile):
+        """
+        Stops requests made within the `with` block, such as token refreshes,
+        from recording their phases in `profile`, unless it is None.
+        """
+        if profile is None:
+            yield
+        else:
+            with profile.suspended():
+                yield
+
+    def geotrigger_stream(self, route, key=None, data='{}'):
+        """
+        Makes a authenticated POST request to the specified `route` of the
+        Geotrigger API, returning an iterator over the elements of the `key`
+        array of the response as they are received. If no `key` is given, it
+        is derived from the route, e.g. 'triggers' for 'trigger/list'.
+        """
         if isinstance(data, dict):
             data = json.dumps(data)
 
+        if key is None:
+            key = route.split('/')[0] + 's'
+
         # Refresh token if necessary
         if datetime.now() > self.expires_at:
             self.refresh()
 
         url = GEOTRIGGER_BASE_URL + route
-        headers = {
+        return self.post_stream(url, key, headers=self.geotrigger_headers(),
+                                data=data)
+
+    def geotrigger_headers(self):
+        """
+        Returns the headers sent with every Geotrigger API request.
+        """
+        return {
             'Content-Type': 'application/json',
             'X-GT-Client-Name': 'geotrigger-python',
             'X-GT-Client-Version': VERSION,
             'Authorization': 'Bearer ' + self.access_token
         }
-        return self.post(url, headers=headers, data=data)
+
+    @contextmanager
+    def deadline(self, seconds):
+        """
+        Limits every request made by the calling thread within the `with`
+        block, including token refreshes and retries, to a total of `seconds`.
+        Requests that would exceed the deadline raise `GeotriggerTimeout`.
+        Nested deadlines can only shorten the enclosing one.
+        """
+        previous = getattr(self._local, 'deadline', None)
+        if seconds is not None:
+            deadline = time.time() + seconds
+            if previous is not None:
+                deadline = min(deadline, previous)
+            self._local.deadline = deadline
+        try:
+            yield
+        finally:
+            self._local.deadline = previous
+
+    def timeout(self):
+        """
+        Returns the (connect, read) timeout for the next request, limited by
+        the time remaining until the current deadline.
+        """
+        deadline = getattr(self._local, 'deadline', None)
+        if deadline is None:
+            return (self.connect_timeout, self.read_timeout)
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise GeotriggerTimeout("Request deadline exceeded.")
+        return tuple(remaining if t is None else min(t, remaining)
+                     for t in (self.connect_timeout, self.read_timeout))
+
+    def hedged_post(self, route, url, data='{}', headers={}):
+        """
+        Makes a POST request like `post`, but if no response has arrived once
+        the request has taken longer than `hedge_percentile` of recent requests
+        to the same `route`, sends the request again and returns whichever
+        response arrives first.
+        """
+        latencies = self._latencies.setdefault(route, deque(maxlen=HEDGE_WINDOW))
+        delay = None
+        if len(latencies) >= HEDGE_MIN_SAMPLES:
+            delay = percentile(latencies, self.hedge_percentile)
+
+        deadline = getattr(self._local, 'deadline', None)
+        results = Queue()
+
+        def attempt():
+            self._local.deadline = deadline
+            start = time.time()
+            try:
+                r = self.post(url, data=data, headers=dict(headers))
+            except Exception as e:
+                results.put((False, e))
+            else:
+                latencies.append(time.time() - start)
+                results.put((True, r))
+
+        def send():
+            thread = threading.Thread(target=attempt)
+            thread.daemon = True
+            thread.start()
+
+        send()
+        outstanding = 1
+        try:
+            ok, result = results.get(True, delay)
+        except Empty:
+            log("Hedging request to {} after {:.3f}s".format(route, delay))
+            send()
+            outstanding = 2
+            ok, result = results.get()
+
+        # If the first answer is an error, wait for the other attempt.
+        if not ok and outstanding == 2:
+            other_ok, other_result = results.get()
+            if other_ok:
+                ok, result = other_ok, other_result
+
+        if not ok:
+            raise result
+        return result
 
     def post(self, url, data='{}', headers={}):
         """
@@ -117,7 +467,21 @@ class GeotriggerSession(object):
             ["{}: {}".format(k, v) for k, v in headers.iteritems()]))
         log("\tData: {}".format(data))
 
-        res = requests.post(url, data=data, headers=headers)
+        profile = None
+        if self.profiler is not None:
+            profile = self.profiler.current()
+
+        deadline = getattr(self._local, 'deadline', None)
+        try:
+            res = http().post(url, data=data, headers=headers,
+                            stream=deadline is not None,
+                            timeout=self.timeout())
+        except requests.exceptions.Timeout as e:
+            raise GeotriggerTimeout("Request timed out. {}".format(e))
+        if deadline is not None:
+            self.read(res, deadline)
+        if profile is not None:
+            profile.lap('wait')
 
         # Check for HTTP errors
         if res.status_code is not STATUS_OK:
@@ -126,6 +490,8 @@ class GeotriggerSession(object):
 
         # Check for application level errors
         r = res.json()
+        if profile is not None:
+            profile.lap('decode')
         log("\tResponse: {}".format(r))
         if ('error' in r):
             if ('code' in r['error']):
@@ -133,17 +499,127 @@ class GeotriggerSession(object):
                 # If token is expired, attempt to refresh it, then retry the request
                 if (status_code == STATUS_TOKEN_EXPIRED):
                     log("Token expired!")
-                    self.refresh()
+                    if profile is not None:
+                        profile.lap('error')
+                    with self.unprofiled(profile):
+                        self.refresh()
+                    if profile is not None:
+                        profile.lap('refresh')
                     if 'Authorization' in headers:
                         headers['Authorization'] = 'Bearer ' + self.access_token
                     return self.post(url, data=data, headers=headers)
-            elif ('message' in r['error']):
+            if ('message' in r['error']):
                 raise GeotriggerException(r['error']['message'])
-            else:
-                raise GeotriggerException("Error making request. " + res.text)
+            raise GeotriggerException("Error making request. " + res.text)
         else:
             return r
 
+    def read(self, res, deadline):
+        """
+        Reads the body of a response requested with `stream=True`, raising
+        `GeotriggerTimeout` if it has not been received by `deadline`.
+        """
+        # The read timeout only limits the wait for each packet, so a body
+        # that trickles in is cut off by shutting down its connection.
+        expired = threading.Event()
+
+        def expire():
+            expired.set()
+            sock = _response_socket(res)
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+        timer = threading.Timer(max(0, deadline - time.time()), expire)
+        timer.daemon = True
+        timer.start()
+        chunks = []
+        try:
+            for chunk in res.iter_content(STREAM_CHUNK_SIZE):
+                if time.time() > deadline:
+                    expired.set()
+                    break
+                chunks.append(chunk)
+        except Exception:
+            if not expired.is_set():
+                raise
+        finally:
+            timer.cancel()
+
+        if expired.is_set():
+            res.close()
+            raise GeotriggerTimeout(
+                "Request deadline exceeded while reading the response.")
+        res._content = b''.join(chunks)
+        return res._content
+
+    def post_stream(self, url, key, data='{}', headers={}):
+        """
+        Makes a POST request to the given `url` and yields the elements of the
+        `key` array of the json response while the body is still downloading,
+        so that very large lists are processed in constant memory.
+        """
+        log("POST {} (streaming '{}')".format(url, key))
+        log("\tHeaders: {}".format(
+            ["{}: {}".format(k, v) for k, v in headers.iteritems()]))
+        log("\tData: {}".format(data))
+
+        try:
+            res = http().post(url, data=data, headers=headers, stream=True,
+                              timeout=self.timeout())
+        except requests.exceptions.Timeout as e:
+            raise GeotriggerTimeout("Request timed out. {}".format(e))
+        expired = False
+        received = 0
+        try:
+            # Check for HTTP errors
+            if res.status_code is not STATUS_OK:
+                raise GeotriggerException(
+                    "Request failed. {}: {}".format(res.status_code, res.text))
+
+            chunks = codecs.iterdecode(
+                res.iter_content(STREAM_CHUNK_SIZE), 'utf-8')
+            try:
+                for item in iter_array(chunks, key, self.check_envelope):
+                    received += 1
+                    yield item
+            except _TokenExpired:
+                if received:
+                    raise GeotriggerException(
+                        "Token expired after {} items were received."
+                        .format(received))
+                expired = True
+        finally:
+            res.close()
+
+        # If token is expired, attempt to refresh it, then retry the request
+        if expired:
+            log("Token expired!")
+            self.refresh()
+            if 'Authorization' in headers:
+                headers['Authorization'] = 'Bearer ' + self.access_token
+            for item in self.post_stream(url, key, data=data, headers=headers):
+                yield item
+
+    def check_envelope(self, name, value):
+        """
+        Checks a top level member of a streamed response for application level
+        errors.
+        """
+        if name != 'error':
+            return
+
+        log("\tResponse error: {}".format(value))
+        if 'code' in value and value['code'] == STATUS_TOKEN_EXPIRED:
+            raise _TokenExpired()
+        elif 'message' in value:
+            raise GeotriggerException(value['message'])
+        else:
+            raise GeotriggerException(
+                "Error making request. {}".format(json.dumps(value)))
+
     def refresh(self):
         raise NotImplementedError(
             "Implemented in GeotriggerApplication and GeotriggerDevice.")
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+A durable write-behind spool for location updates.
+
+Delivery is at least once, not exactly once. Fixes are deleted from the
+spool only after the API has accepted the batch that contains them. If the
+process dies after a batch is sent but before it is deleted, that batch is
+sent again on the next drain. This duplicates at most one batch per device
+per crash. 'location/update' has no idempotency key, so the spool cannot
+find out whether the API received an in-flight batch before the crash.
+"""
+import sqlite3
+import threading
+
+from models import LocationBatch, to_epoch
+from parallel import parallel_map
+from session import GeotriggerException, log
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fixes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    device_id TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    latitude REAL NOT NULL,
+    longitude REAL NOT NULL,
+    accuracy REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fixes_device ON fixes (device_id, id);
+"""
+
+LOCATION_UPDATE_ROUTE = 'location/update'
+
+
+class LocationSpool(object):
+    """
+    A durable write-behind spool for location updates, backed by a sqlite
+    database on local disk.
+
+    Fixes are accepted with `put` at local disk speed, whether or not the
+    Geotrigger API is reachable, and are sent later with `drain` (or
+    periodically by a background thread, see `start`). Each device's fixes are
+    sent in the order they were spooled, in batches of up to `batch_size`
+    fixes, by at most `workers` concurrent requests.
+
+    Fixes are only removed from the spool once the API has accepted them, so
+    they survive process restarts and outages.
+    """
+
+    def __init__(self, path, batch_size=100, workers=4):
+        """
+        Opens (or creates) the spool database at `path`.
+        """
+        if batch_size < 1:
+            raise ValueError('batch_size must be at least 1.')
+        if workers < 1:
+            raise ValueError('workers must be at least 1.')
+
+        self.path = path
+        self.batch_size = batch_size
+        self.workers = workers
+        self.failures = {}
+
+        self._local = threading.local()
+        self._drain_lock = threading.Lock()
+        self._count_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self.connection().executescript(SCHEMA)
+
+    def connection(self):
+        """
+        Returns the sqlite connection for the calling thread.
+        """
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            # Write ahead logging lets `put` proceed while a drain is reading,
+            # and only syncs to disk at checkpoints.
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    def put(self, device_id, timestamp, latitude, longitude, accuracy):
+        """
+        Spools a single fix for the given device. The `timestamp` may be given
+        as seconds since the epoch, a `datetime` or an ISO 8601 string.
+        """
+        db = self.connection()
+        with db:
+            db.execute(
+                'INSERT INTO fixes (device_id, timestamp, latitude, longitude, '
+                'accuracy) VALUES (?, ?, ?, ?, ?)',
+                (device_id, to_epoch(timestamp), latitude, longitude,
+                 accuracy))
+
+    def put_batch(self, device_id, batch):
+        """
+        Spools every fix of a `LocationBatch` for the given device in a single
+        transaction.
+        """
+        db = self.connection()
+        with db:
+            db.executemany(
+                'INSERT INTO fixes (device_id, timestamp, latitude, longitude, '
+                'accuracy) VALUES (?, ?, ?, ?, ?)',
+                ((device_id,) + fix for fix in batch))
+
+    def pending(self, device_id=None):
+        """
+        Returns the number of spooled fixes, optionally for a single device.
+        """
+        if device_id is None:
+            row = self.connection().execute(
+                'SELECT COUNT(*) FROM fixes').fetchone()
+        else:
+            row = self.connection().execute(
+                'SELECT COUNT(*) FROM fixes WHERE device_id = ?',
+                (device_id,)).fetchone()
+        return row[0]
+
+    def devices(self):
+        """
+        Returns the ids of all devices with spooled fixes.
+        """
+        rows = self.connection().execute(
+            'SELECT DISTINCT device_id FROM fixes').fetchall()
+        return [row[0] for row in rows]
+
+    def drain(self, sessions):
+        """
+        Sends spooled fixes to the Geotrigger API and returns the number of
+        fixes sent. `sessions` maps device ids to the `GeotriggerDevice` (or
+        other session) used to send that device's fixes; devices without a
+        session are left in the spool.
+
+        A device whose request fails is skipped until the next drain, and the
+        exception is recorded in `failures`.
+        """
+        with self._drain_lock:
+            device_ids = [d for d in self.devices() if d in sessions]
+            sent = [0]
+            results = parallel_map(
+                lambda d: self._drain_device(d, sessions[d], sent),
+                device_ids, self.workers)
+
+            self.failures = {}
+            for device_id, result in zip(device_ids, results):
+                if isinstance(result, Exception):
+                    log("Could not send spooled fixes for {}: {}".format(
+                        device_id, result))
+                    self.failures[device_id] = result
+            return sent[0]
+
+    def _drain_device(self, device_id, session, sent):
+        db = self.connection()
+        while True:
+            rows = db.execute(
+                'SELECT id, timestamp, latitude, longitude, accuracy '
+                'FROM fixes WHERE device_id = ? ORDER BY id LIMIT ?',
+                (device_id, self.batch_size)).fetchall()
+            if not rows:
+                return
+
+            batch = LocationBatch()
+            for row in rows:
+                batch.append(*row[1:])
+            response = session.geotrigger_request(LOCATION_UPDATE_ROUTE,
+                                                  batch.dumps())
+            if response is None:
+                raise GeotriggerException(
+                    'The location update was not accepted.')
+
+            with db:
+                db.execute('DELETE FROM fixes WHERE device_id = ? AND id <= ?',
+                           (device_id, rows[-1][0]))
+            with self._count_lock:
+                sent[0] += len(rows)
+
+    def start(self, sessions, interval=30, max_interval=600):
+        """
+        Starts a background thread that drains the spool every `interval`
+        seconds, backing off up to `max_interval` seconds while requests are
+        failing.
+        """
+        if self._thread is not None:
+            raise GeotriggerException('The spool is already draining.')
+
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(sessions, interval, max_interval))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the background thread started with `start`, waiting for a drain
+        in progress to finish.
+        """
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, sessions, interval, max_interval):
+        wait = interval
+        while not self._stopped.is_set():
+            self.drain(sessions)
+            if self.failures:
+                wait = min(wait * 2, max_interval)
+            else:
+                wait = interval
+            self._stopped.wait(wait)
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+from math import ceil
+
+
+def percentile(values, p):
+    """
+    Returns the `p`th percentile of `values` by the nearest rank method, or
+    None if there are no values.
+    """
+    if not len(values):
+        return None
+    values = sorted(values)
+    rank = int(ceil(p / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
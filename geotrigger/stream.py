@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import json
+
+WHITESPACE = u' \t\n\r'
+DELIMITERS = WHITESPACE + u',]}'
+
+_decoder = json.JSONDecoder()
+
+
+class _Reader(object):
+    """
+    A growable window over an iterable of text chunks.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = u''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """
+        Appends the next chunk to the buffer, discarding everything that has
+        already been consumed. Returns False once the chunks are exhausted.
+        """
+        for chunk in self.chunks:
+            if chunk:
+                self.buf = self.buf[self.pos:] + chunk
+                self.pos = 0
+                return True
+        self.eof = True
+        return False
+
+    def peek(self):
+        """
+        Skips whitespace and returns the next character without consuming it,
+        or None at the end of the stream.
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return None
+
+    def expect(self, *expected):
+        """
+        Consumes and returns the next non-whitespace character, which must be
+        one of `expected`.
+        """
+        c = self.peek()
+        if c is None or c not in expected:
+            raise ValueError("Expected {} in json stream, got {}.".format(
+                " or ".join(expected), repr(c)))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """
+        Decodes and consumes one complete json value.
+        """
+        if self.peek() is None:
+            raise ValueError("Unexpected end of json stream.")
+
+        while True:
+            try:
+                obj, end = _decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                obj, end = None, None
+
+            # A number may continue in the next chunk unless it is followed by
+            # a delimiter, every other json value is self delimiting.
+            complete = end is not None and (
+                self.eof or
+                isinstance(obj, bool) or
+                not isinstance(obj, (int, long, float)) or
+                (end < len(self.buf) and self.buf[end] in DELIMITERS))
+
+            if complete:
+                self.pos = end
+                return obj
+
+            if self.eof:
+                raise ValueError("Unexpected end of json stream.")
+
+            # Read at least as much again before the next attempt so that a
+            # large value is not decoded once per chunk.
+            wanted = 2 * (len(self.buf) - self.pos)
+            while len(self.buf) - self.pos < wanted and self.fill():
+                pass
+
+
+def iter_array(chunks, key, on_member=None):
+    """
+    Incrementally parses a json object from an iterable of text `chunks`,
+    yielding each element of the array stored under the top level `key` as
+    soon as it has been received.
+
+    Every other top level member is decoded whole and passed to
+    `on_member(name, value)` as soon as it is complete, which allows the
+    caller to inspect an error envelope before (or instead of) the array.
+    """
+    reader = _Reader(chunks)
+    reader.expect(u'{')
+
+    if reader.peek() == u'}':
+        reader.pos += 1
+        return
+
+    while True:
+        name = reader.value()
+        reader.expect(u':')
+
+        if name == key and reader.peek() == u'[':
+            reader.pos += 1
+            if reader.peek() == u']':
+                reader.pos += 1
+            else:
+                while True:
+                    yield reader.value()
+                    if reader.expect(u',', u']') == u']':
+                        break
+        else:
+            value = reader.value()
+            if on_member:
+                on_member(name, value)
+
+        if reader.expect(u',', u'}') == u'}':
+            break
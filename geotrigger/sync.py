@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+from parallel import parallel_map
+from session import GeotriggerException, log
+
+# The routes and json names used to list and update each kind of object.
+KINDS = {
+    'trigger': {
+        'list': 'trigger/list',
+        'update': 'trigger/update',
+        'ids': 'triggerIds',
+        'objects': 'triggers',
+        'id': 'triggerId'
+    },
+    'device': {
+        'list': 'device/list',
+        'update': 'device/update',
+        'ids': 'deviceIds',
+        'objects': 'devices',
+        'id': 'deviceId'
+    }
+}
+
+# Maximum number of ids sent in a single list or update request.
+MAX_IDS = 500
+
+
+class TagUpdate(object):
+    """
+    A single 'trigger/update' or 'device/update' request that adds and removes
+    the same tags on many objects.
+    """
+
+    def __init__(self, kind, ids, add=(), remove=()):
+        self.kind = kind
+        self.ids = sorted(ids)
+        self.add = sorted(add)
+        self.remove = sorted(remove)
+
+    @property
+    def route(self):
+        return KINDS[self.kind]['update']
+
+    def payload(self):
+        """
+        Returns the request data for this update.
+        """
+        data = {KINDS[self.kind]['ids']: self.ids}
+        if self.add:
+            data['addTags'] = self.add
+        if self.remove:
+            data['removeTags'] = self.remove
+        return data
+
+    def __str__(self):
+        return '{} {} {}s: {}'.format(
+            self.route, len(self.ids), self.kind, ' '.join(
+                ['+' + t for t in self.add] + ['-' + t for t in self.remove]))
+
+
+class TagSync(object):
+    """
+    Synchronizes the tags of triggers or devices with a desired mapping of
+    object ids to tags, using as few update requests as possible.
+
+    The current tags of every object in the mapping are fetched, and the
+    objects that need the same change are grouped into a single update
+    request, either by their whole change or by each tag that is added or
+    removed, whichever takes fewer requests. Requests are made by `workers`
+    threads in parallel, except that requests for the same object are made
+    one after another.
+
+        >>> sync = TagSync(gt, 'trigger')
+        >>> for update in sync.sync(desired, dry_run=True):
+        ...     print update
+
+    The default tag of each object (e.g. 'trigger:<id>') is never removed.
+    Ids that do not exist are skipped and listed in `missing`.
+    """
+
+    def __init__(self, client, kind='trigger', workers=8, max_ids=MAX_IDS):
+        if kind not in KINDS:
+            raise ValueError('kind must be one of: {}'.format(
+                ', '.join(sorted(KINDS))))
+
+        self.client = client
+        self.kind = kind
+        self.workers = workers
+        self.max_ids = max_ids
+        self.missing = []
+        self.failures = []
+
+    def current(self, ids):
+        """
+        Fetches the current tags of the objects with the given ids, returning
+        a dict mapping ids to sets of tags.
+        """
+        names = KINDS[self.kind]
+        chunks = _chunks(ids, self.max_ids)
+
+        def fetch(chunk):
+            return [(obj[names['id']], set(obj.get('tags') or ()))
+                    for obj in self.client.request_stream(
+                        names['list'], names['objects'], {names['ids']: chunk})]
+
+        tags = {}
+        for result in parallel_map(fetch, chunks, self.workers):
+            if isinstance(result, Exception):
+                raise result
+            tags.update(result)
+        return tags
+
+    def plan(self, desired, current=None):
+        """
+        Returns the list of `TagUpdate` requests needed to give every object
+        in `desired`, a dict mapping ids to iterables of tags, exactly those
+        tags. The `current` tags are fetched unless given.
+        """
+        if current is None:
+            current = self.current(desired.keys())
+
+        self.missing = []
+        changes = {}
+        for object_id, tags in desired.iteritems():
+            if object_id not in current:
+                self.missing.append(object_id)
+                continue
+            tags = set(tags)
+            default = '{}:{}'.format(self.kind, object_id)
+            add = frozenset(tags - current[object_id])
+            remove = frozenset(current[object_id] - tags - set([default]))
+            if add or remove:
+                changes[object_id] = (add, remove)
+
+        # Group objects by their whole change...
+        by_change = {}
+        for object_id, change in changes.iteritems():
+            by_change.setdefault(change, []).append(object_id)
+        plan_by_change = [
+            TagUpdate(self.kind, chunk, add, remove)
+            for (add, remove), ids in by_change.iteritems()
+            for chunk in _chunks(ids, self.max_ids)
+        ]
+
+        # ...or by each tag that is added or removed.
+        adds = {}
+        removes = {}
+        for object_id, (add, remove) in changes.iteritems():
+            for tag in add:
+                adds.setdefault(tag, []).append(object_id)
+            for tag in remove:
+                removes.setdefault(tag, []).append(object_id)
+        plan_by_tag = [
+            TagUpdate(self.kind, chunk, add=[tag])
+            for tag, ids in adds.iteritems()
+            for chunk in _chunks(ids, self.max_ids)
+        ] + [
+            TagUpdate(self.kind, chunk, remove=[tag])
+            for tag, ids in removes.iteritems()
+            for chunk in _chunks(ids, self.max_ids)
+        ]
+
+        if len(plan_by_tag) < len(plan_by_change):
+            return plan_by_tag
+        return plan_by_change
+
+    def apply(self, plan):
+        """
+        Makes the update requests of a plan in parallel and returns their
+        responses. An update waits for earlier updates of the same objects,
+        so that concurrent updates never overwrite each other's tags. Updates
+        that fail are listed with their exception in
+        `failures`, and a `GeotriggerException` is raised once every update
+        has been attempted.
+        """
+        def update(update):
+            log("Sync: {}".format(update))
+            return self.client.request(update.route, update.payload())
+
+        results = [None] * len(plan)
+        for wave in _waves(plan):
+            for i, result in zip(wave, parallel_map(
+                    update, [plan[i] for i in wave], self.workers)):
+                results[i] = result
+
+        self.failures = [(u, r) for u, r in zip(plan, results)
+                         if isinstance(r, Exception)]
+        if self.failures:
+            raise GeotriggerException('{} of {} tag updates failed: {}'.format(
+                len(self.failures), len(plan), self.failures[0][1]))
+        return results
+
+    def sync(self, desired, dry_run=False):
+        """
+        Plans and, unless `dry_run` is true, applies the updates needed to make
+        the tags of the objects in `desired` match. Returns the plan.
+        """
+        plan = self.plan(desired)
+        if not dry_run:
+            self.apply(plan)
+        return plan
+
+
+def _waves(plan):
+    """
+    Splits the indexes of the updates of `plan` into lists, in order, that
+    each update an object at most once.
+    """
+    waves = []
+    for i, update in enumerate(plan):
+        for ids, wave in waves:
+            if ids.isdisjoint(update.ids):
+                break
+        else:
+            ids, wave = set(), []
+            waves.append((ids, wave))
+        ids.update(update.ids)
+        wave.append(i)
+    return [wave for ids, wave in waves]
+
+
+def _chunks(items, size):
+    items = sorted(items)
+    return [items[i:i + size] for i in range(0, len(items), size)]
@@ -17,6 +17,9 @@ setup(
     author_email='jyaganeh@esri.com',
     url='https://github.com/esri/geotrigger-python',
     packages=['geotrigger', ],
+    entry_points={
+        'console_scripts': ['geotrigger = geotrigger.cli:main']
+    },
     classifiers=[
         'Development Status :: 4 - Beta', # 4 Beta, 5 Production/Stable
         'Environment :: Console',
@@ -3,14 +3,38 @@
 import unittest
 from unittest import TestCase
 from datetime import datetime, timedelta
+import BaseHTTPServer
+import SocketServer
 import json
-
-from mock import patch
+import os
+import pickle
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from StringIO import StringIO
+
+import requests
+from mock import Mock, patch
 
 from geotrigger import GeotriggerClient, GeotriggerDevice, \
     GeotriggerApplication, __version__
 from geotrigger.session import GeotriggerSession, GEOTRIGGER_BASE_URL, \
-    AGO_TOKEN_ROUTE, EXPIRES_IN_PADDING
+    AGO_TOKEN_ROUTE, EXPIRES_IN_PADDING, GeotriggerException, \
+    GeotriggerTimeout, HEDGE_MIN_SAMPLES, http
+from geotrigger.analyze import TriggerAnalyzer
+from geotrigger.cli import TokenCache, main, pipeline
+from geotrigger.models import Trigger, Device, Tag, LocationBatch
+from geotrigger.parallel import parallel_map
+from geotrigger.pool import DevicePool
+from geotrigger.profiling import Profiler
+from geotrigger.receiver import CallbackReceiver
+from geotrigger.replay import Replay, load_traces
+from geotrigger.spool import LocationSpool
+from geotrigger.stats import percentile
+from geotrigger.stream import iter_array
+from geotrigger.sync import TagSync
 
 
 class GeotriggerClientTestCase(TestCase):
@@ -389,5 +413,1138 @@ class GeotriggerSessionTestCase(TestCase):
         self.assertIsNotNone(session.expires_at)
         self.assertAlmostEqual(expected, session.expires_at, delta=self.fudge_factor)
 
+    def test_credentials(self):
+        """
+        Test that sessions are restored from their stored credentials.
+        """
+        device = GeotriggerDevice(self.client_id, self.device_id,
+                                  self.access_token, self.refresh_token,
+                                  self.expires_in)
+        credentials = json.loads(json.dumps(device.credentials()))
+        copy = GeotriggerSession.from_credentials(self.client_id, credentials)
+        self.assertIsInstance(copy, GeotriggerDevice)
+        for name in ('device_id', 'access_token', 'refresh_token'):
+            self.assertEqual(getattr(copy, name), getattr(device, name))
+        self.assertTrue(
+            abs((copy.expires_at - device.expires_at).total_seconds()) < 2)
+
+        # expired tokens are kept, to be refreshed on first use
+        credentials['expires_at'] = time.time() - 1000
+        copy = GeotriggerSession.from_credentials(self.client_id, credentials)
+        self.assertEqual(copy.expires_in, 0)
+
+        with patch.object(GeotriggerApplication, 'refresh') as refresh:
+            app = GeotriggerSession.from_credentials(
+                self.client_id, {'access_token': 'app', 'expires_at': None},
+                self.client_secret)
+            self.assertEqual(refresh.call_count, 0)
+        self.assertIsInstance(app, GeotriggerApplication)
+        self.assertIsNone(app.expires_at)
+
+    def test_pickle(self):
+        """
+        Test that sessions can be pickled, for example to send them to worker
+        processes.
+        """
+        session = GeotriggerDevice(self.client_id, self.device_id,
+                                   self.access_token, self.refresh_token,
+                                   self.expires_in)
+        session.read_timeout = 5
+        session.profiler = Profiler()
+        with session.deadline(10):
+            copy = pickle.loads(pickle.dumps(session))
+
+        for name in ('client_id', 'device_id', 'access_token',
+                     'refresh_token', 'expires_at', 'read_timeout'):
+            self.assertEqual(getattr(copy, name), getattr(session, name))
+        self.assertIsNone(copy.profiler)
+        self.assertIsNone(getattr(copy._local, 'deadline', None))
+        self.assertEqual(copy._latencies, {})
+
+    @patch('geotrigger.session.requests', requests)
+    @patch('geotrigger.session.http')
+    def test_timeout(self, mock_http):
+        """
+        Test that requests are limited by the timeouts and current deadline.
+        """
+        mock_session = mock_http.return_value
+        res = mock_session.post.return_value
+        res.status_code = 200
+        res.json.return_value = {}
+        res.iter_content.return_value = ['{}']
+
+        session = GeotriggerSession(self.client_id, self.client_secret,
+                                    self.access_token)
+        session.post('url')
+        self.assertEqual(mock_session.post.call_args[1]['timeout'],
+                         (session.connect_timeout, session.read_timeout))
+
+        with session.deadline(2):
+            session.post('url')
+            connect, read = mock_session.post.call_args[1]['timeout']
+            self.assertLessEqual(connect, 2)
+            self.assertLessEqual(read, 2)
+
+            with session.deadline(0):
+                self.assertRaises(GeotriggerTimeout, session.post, 'url')
+
+        mock_session.post.side_effect = requests.exceptions.ReadTimeout()
+        self.assertRaises(GeotriggerTimeout, session.post, 'url')
+
+    def test_deadline_slow_body(self):
+        """
+        Test that a deadline limits the time spent reading a slow body.
+        """
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                body = '{"triggers": []}    '
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                try:
+                    for c in body:
+                        self.wfile.write(c)
+                        self.wfile.flush()
+                        time.sleep(0.05)
+                except socket.error:
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.addCleanup(server.server_close)
+        url = 'http://127.0.0.1:{}/'.format(server.server_port)
+        gt = GeotriggerClient(session=GeotriggerSession(
+            self.client_id, self.client_secret, self.access_token,
+            expires_in=800))
+
+        with patch('geotrigger.session.GEOTRIGGER_BASE_URL', url):
+            thread = threading.Thread(target=server.handle_request)
+            thread.start()
+            start = time.time()
+            self.assertRaises(GeotriggerTimeout, gt.request, 'trigger/list',
+                              deadline=0.3)
+            self.assertLess(time.time() - start, 0.6)
+            thread.join()
+
+            # the whole body arrives within a longer deadline
+            thread = threading.Thread(target=server.handle_request)
+            thread.start()
+            self.assertEqual(gt.request('trigger/list', deadline=5),
+                             {'triggers': []})
+            thread.join()
+
+    def test_http_fork(self):
+        """
+        Test that a forked process does not reuse its parent's connections.
+        """
+        ports = []
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                ports.append(self.client_address[1])
+                body = '{}'
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = Server(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:{}/'.format(server.server_port)
+
+        session = GeotriggerSession(self.client_id, self.client_secret,
+                                    self.access_token, expires_in=800)
+        session.post(url, '{}', {})
+        parent = http()
+
+        pid = os.fork()
+        if pid == 0:
+            ok = False
+            try:
+                ok = http() is not parent and session.post(url, '{}', {}) == {}
+            finally:
+                os._exit(0 if ok else 1)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+        # the parent keeps its session and its kept alive connection
+        session.post(url, '{}', {})
+        self.assertIs(http(), parent)
+        self.assertEqual(len(ports), 3)
+        self.assertNotEqual(ports[1], ports[0])
+        self.assertEqual(ports[2], ports[0])
+
+    @patch.object(GeotriggerSession, 'post')
+    def test_hedged_request(self, mock_post):
+        """
+        Test that a slow read request is sent a second time.
+        """
+        session = GeotriggerSession(self.client_id, self.client_secret,
+                                    self.access_token, expires_in=800)
+        session.hedge_percentile = 90
+
+        # hedging is off until enough latencies have been recorded
+        mock_post.return_value = {'triggers': []}
+        for i in range(HEDGE_MIN_SAMPLES):
+            session.geotrigger_request('trigger/list')
+        self.assertEqual(mock_post.call_count, HEDGE_MIN_SAMPLES)
+
+        release = threading.Event()
+
+        def post(url, data, headers):
+            if mock_post.call_count == HEDGE_MIN_SAMPLES + 1:
+                release.wait()
+                return {'triggers': ['slow']}
+            return {'triggers': ['fast']}
+        mock_post.side_effect = post
+
+        response = session.geotrigger_request('trigger/list')
+        release.set()
+
+        self.assertEqual(response, {'triggers': ['fast']})
+        self.assertEqual(mock_post.call_count, HEDGE_MIN_SAMPLES + 2)
+
+        # write routes are never hedged
+        mock_post.side_effect = None
+        session.geotrigger_request('trigger/create')
+        self.assertEqual(mock_post.call_count, HEDGE_MIN_SAMPLES + 3)
+
+
+class GeotriggerStreamTestCase(TestCase):
+    """
+    Tests for incremental parsing of streamed responses.
+    """
+
+    def setUp(self):
+        self.response = {
+            'boundingBox': None,
+            'triggers': [
+                {'triggerId': 'a', 'tags': ['one', 'two'], 'distance': 100},
+                {'triggerId': 'b', 'tags': [], 'distance': 12.5e3},
+                {'triggerId': u'\u00e9', 'tags': None, 'distance': -7}
+            ],
+            'count': 1234
+        }
+        self.body = json.dumps(self.response, indent=2)
+
+    def chunked(self, text, size):
+        return [text[i:i + size] for i in range(0, len(text), size)]
+
+    def test_iter_array(self):
+        """
+        Test that array elements are yielded regardless of chunk boundaries.
+        """
+        for size in (1, 2, 3, 7, 64, len(self.body)):
+            members = {}
+            items = list(iter_array(self.chunked(self.body, size), 'triggers',
+                                    members.__setitem__))
+
+            self.assertEqual(items, self.response['triggers'])
+            self.assertEqual(members, {'boundingBox': None, 'count': 1234})
+
+    def test_iter_array_is_incremental(self):
+        """
+        Test that the first element is yielded before the body is complete.
+        """
+        chunks = self.chunked(self.body, 16)
+        consumed = []
+
+        def source():
+            for chunk in chunks:
+                consumed.append(chunk)
+                yield chunk
+
+        first = next(iter_array(source(), 'triggers'))
+        self.assertEqual(first, self.response['triggers'][0])
+        self.assertLess(len(consumed), len(chunks))
+
+    def test_iter_array_truncated(self):
+        """
+        Test that a truncated body raises an error.
+        """
+        with self.assertRaises(ValueError):
+            list(iter_array(self.chunked(self.body[:-40], 5), 'triggers'))
+
+    @patch('geotrigger.session.http')
+    def test_post_stream_error(self, mock_http):
+        """
+        Test that an error envelope is detected in a streamed response.
+        """
+        mock_session = mock_http.return_value
+        res = mock_session.post.return_value
+        res.status_code = 200
+        res.iter_content.return_value = self.chunked(
+            '{"error": {"message": "Invalid trigger"}}', 4)
+
+        session = GeotriggerSession('client_id', access_token='token',
+                                    expires_in=800)
+        with self.assertRaises(GeotriggerException):
+            list(session.post_stream(GEOTRIGGER_BASE_URL + 'trigger/list',
+                                     'triggers'))
+        res.close.assert_called_once_with()
+
+    @patch.object(GeotriggerSession, 'refresh')
+    @patch('geotrigger.session.http')
+    def test_post_stream_expired(self, mock_http, mock_refresh):
+        """
+        Test that a streamed request is retried after refreshing an expired
+        token.
+        """
+        mock_session = mock_http.return_value
+        expired = mock_session.post.return_value
+        expired.status_code = 200
+        expired.iter_content.return_value = [
+            '{"error": {"code": 498, "message": "Invalid token"}}']
+
+        session = GeotriggerSession('client_id', access_token='token',
+                                    expires_in=800)
+
+        def refresh():
+            session.access_token = 'new_token'
+            res = mock_session.post.return_value = type(expired)()
+            res.status_code = 200
+            res.iter_content.return_value = self.chunked(self.body, 10)
+        mock_refresh.side_effect = refresh
+
+        items = list(session.geotrigger_stream('trigger/list'))
+
+        self.assertEqual(items, self.response['triggers'])
+        self.assertEqual(mock_refresh.call_count, 1)
+        self.assertEqual(mock_session.post.call_count, 2)
+        headers = mock_session.post.call_args[1]['headers']
+        self.assertEqual(headers['Authorization'], 'Bearer new_token')
+
+
+class GeotriggerModelsTestCase(TestCase):
+    """
+    Tests for the compact model classes.
+    """
+
+    def setUp(self):
+        self.trigger = {
+            'triggerId': 'esri_hq',
+            'condition': {
+                'geo': {
+                    'latitude': 34.0562,
+                    'longitude': -117.1956,
+                    'distance': 100
+                },
+                'direction': 'enter'
+            },
+            'action': {'callbackUrl': 'http://example.com/callback'},
+            'tags': ['trigger:esri_hq', 'hq'],
+            'times': {'enterCount': 1}
+        }
+
+    def test_trigger(self):
+        """
+        Test conversion of triggers to and from API json.
+        """
+        trigger = Trigger.from_json(self.trigger)
+
+        self.assertTrue(trigger.is_circle())
+        self.assertEqual(trigger.trigger_id, 'esri_hq')
+        self.assertEqual(trigger.direction, 'enter')
+        self.assertEqual(trigger.distance, 100)
+        self.assertEqual(trigger.tags, ('trigger:esri_hq', 'hq'))
+        self.assertEqual(trigger.extra, {'times': {'enterCount': 1}})
+        self.assertFalse(hasattr(trigger, '__dict__'))
+        self.assertEqual(trigger.to_json(), self.trigger)
+
+        # members missing from the API object are not added
+        for obj in ({'triggerId': 'a'}, {'triggerId': 'a', 'condition': {}},
+                    {'triggerId': 'a', 'tags': []}):
+            self.assertEqual(Trigger.from_json(obj).to_json(), obj)
+
+    def test_device_and_tag(self):
+        """
+        Test conversion of devices and tags to and from API json.
+        """
+        device = {'deviceId': 'abc', 'tags': ['device:abc'],
+                  'trackingProfile': 'adaptive', 'lastSeen': 'never'}
+        self.assertEqual(Device.from_json(device).to_json(), device)
+        self.assertEqual(Device.from_json({'deviceId': 'abc'}).to_json(),
+                         {'deviceId': 'abc'})
+
+        tag = Tag.from_json({'name': 'hq', 'triggerList': True,
+                             'deviceList': False})
+        self.assertTrue(tag.can('triggerList'))
+        self.assertFalse(tag.can('deviceList'))
+        self.assertEqual(Tag.from_json(tag.to_json()).permissions,
+                         tag.permissions)
+
+    def test_location_batch(self):
+        """
+        Test serialization of location batches.
+        """
+        batch = LocationBatch()
+        batch.append(1388534400.25, 34.0562, -117.1956, 5)
+        batch.append('2014-01-01T00:00:01-08:00', 45.5165, -122.6764, 10.5)
+
+        self.assertEqual(len(batch), 2)
+        self.assertEqual(json.loads(batch.dumps()), {'locations': [
+            {'timestamp': '2014-01-01T00:00:00.250Z',
+             'latitude': 34.0562, 'longitude': -117.1956, 'accuracy': 5.0},
+            {'timestamp': '2014-01-01T08:00:01.000Z',
+             'latitude': 45.5165, 'longitude': -122.6764, 'accuracy': 10.5}
+        ]})
+
+        payload = batch.to_json(previous=(datetime(2014, 1, 1), 1, 2, 3))
+        self.assertEqual(payload['previous']['timestamp'],
+                         '2014-01-01T00:00:00.000Z')
+        self.assertEqual(list(LocationBatch.from_json(payload)), list(batch))
+        self.assertEqual(list(batch.slice(1)), list(batch)[1:])
+
+
+class LocationSpoolTestCase(TestCase):
+    """
+    Tests for the `LocationSpool` class.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'spool.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_drain(self):
+        """
+        Test that spooled fixes are sent in order and in batches.
+        """
+        spool = LocationSpool(self.path, batch_size=2)
+        for i in range(5):
+            spool.put('a', 1388534400 + i, 34.0 + i, -117.0, 5)
+        spool.put('b', 1388534400, 45.5, -122.6, 5)
+
+        # reopen to make sure fixes are persisted
+        spool = LocationSpool(self.path, batch_size=2)
+        self.assertEqual(spool.pending(), 6)
+        self.assertEqual(sorted(spool.devices()), ['a', 'b'])
+
+        session = Mock()
+        self.assertEqual(spool.drain({'a': session}), 5)
+        self.assertEqual(spool.pending(), 1)
+        self.assertEqual(spool.pending('b'), 1)
+
+        self.assertEqual(session.geotrigger_request.call_count, 3)
+        latitudes = []
+        for args, kwargs in session.geotrigger_request.call_args_list:
+            self.assertEqual(args[0], 'location/update')
+            latitudes += [l['latitude'] for l in json.loads(args[1])['locations']]
+        self.assertEqual(latitudes, [34.0, 35.0, 36.0, 37.0, 38.0])
+
+    def test_drain_failure(self):
+        """
+        Test that fixes are kept in the spool when a request fails.
+        """
+        spool = LocationSpool(self.path, batch_size=2)
+        for i in range(3):
+            spool.put('a', 1388534400 + i, 34.0, -117.0, 5)
+
+        session = Mock()
+        session.geotrigger_request.side_effect = [{}, GeotriggerException()]
+
+        self.assertEqual(spool.drain({'a': session}), 2)
+        self.assertIn('a', spool.failures)
+        self.assertEqual(spool.pending('a'), 1)
+
+        session.geotrigger_request.side_effect = None
+        self.assertEqual(spool.drain({'a': session}), 1)
+        self.assertEqual(spool.failures, {})
+        self.assertEqual(spool.pending(), 0)
+
+    @patch('geotrigger.session.http')
+    def test_drain_error_response(self, mock_http):
+        """
+        Test that fixes are kept when the API answers with an error.
+        """
+        res = mock_http.return_value.post.return_value
+        res.status_code = 200
+        res.json.return_value = {
+            'error': {'code': 400, 'message': 'Invalid locations'}}
+
+        spool = LocationSpool(self.path)
+        spool.put('a', 1388534400, 34.0, -117.0, 5)
+        session = GeotriggerSession('test_client_id', 'test_client_secret',
+                                    'test_access_token', expires_in=800)
+
+        self.assertEqual(spool.drain({'a': session}), 0)
+        self.assertEqual(str(spool.failures['a']), 'Invalid locations')
+        self.assertEqual(spool.pending('a'), 1)
+
+
+class ReplayTestCase(TestCase):
+    """
+    Tests for replaying recorded traces.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_load_traces(self):
+        """
+        Test reading GPX, CSV and NDJSON traces.
+        """
+        traces = load_traces([
+            self.write('a.csv', 'device_id,timestamp,latitude,longitude\n'
+                                'car1,2014-01-01T00:00:10Z,34.1,-117.1\n'
+                                'car1,1388534400,34.0,-117.0\n'),
+            self.write('b.ndjson', '{"deviceId": "car2", "timestamp": 1388534400,'
+                                   ' "latitude": 45.5, "longitude": -122.6,'
+                                   ' "accuracy": 3}\n'),
+            self.write('car3.gpx', '<gpx xmlns="http://www.topografix.com/GPX/1/1">'
+                                   '<trk><trkseg><trkpt lat="1.5" lon="2.5">'
+                                   '<time>2014-01-01T00:00:00Z</time>'
+                                   '</trkpt></trkseg></trk></gpx>')
+        ])
+
+        self.assertEqual(traces, {
+            'car1': [(1388534400.0, 34.0, -117.0, 10.0),
+                     (1388534410.0, 34.1, -117.1, 10.0)],
+            'car2': [(1388534400.0, 45.5, -122.6, 3.0)],
+            'car3': [(1388534400.0, 1.5, 2.5, 10)]
+        })
+
+    def test_percentile(self):
+        """
+        Test nearest rank percentiles.
+        """
+        values = range(1, 101)
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertIsNone(percentile([], 50))
+
+    @patch('geotrigger.replay.GeotriggerDevice')
+    def test_run(self, mock_device):
+        """
+        Test that every fix is sent by the worker processes.
+        """
+        traces = dict(
+            ('car%d' % i, [(1388534400.0 + t, 34.0, -117.0, 5.0)
+                           for t in range(3)])
+            for i in range(5))
+
+        report = Replay('client_id', traces, processes=2, threads=2,
+                        speed=None).run()
+
+        self.assertEqual(report.sent, 15)
+        self.assertEqual(report.errors, 0)
+        self.assertEqual(len(report.latencies), 15)
+        self.assertIsNotNone(report.latency(99))
+        self.assertIn('15 location updates', str(report))
+
+    @patch('geotrigger.replay.GeotriggerDevice')
+    def test_run_failures(self, mock_device):
+        """
+        Test that bad fixes are counted as errors, and that a worker that dies
+        fails the replay instead of hanging it.
+        """
+        traces = {'a': [(0.0, 1.0, 2.0, 5.0)], 'b': [(1.0, 'x', 2.0, 5.0)]}
+        report = Replay('client_id', traces, processes=2, speed=None).run()
+        self.assertEqual(report.sent, 1)
+        self.assertEqual(report.errors, 1)
+
+        with patch('geotrigger.replay._replay_shard',
+                   side_effect=lambda *args: os._exit(3)):
+            self.assertRaises(GeotriggerException,
+                              Replay('client_id', traces, processes=2).run)
+
+
+class CallbackReceiverTestCase(TestCase):
+    """
+    Tests for the `CallbackReceiver` class.
+    """
+
+    def setUp(self):
+        self.callback = {
+            'trigger': {'triggerId': 'esri_hq'},
+            'device': {'deviceId': 'device_id'},
+            'location': {'timestamp': '2014-01-01T00:00:00Z'}
+        }
+        self.body = json.dumps(self.callback)
+
+    def test_dispatch(self):
+        """
+        Test that callbacks are dispatched to handlers and deduplicated.
+        """
+        receiver = CallbackReceiver(host='127.0.0.1', port=0, path='/hook',
+                                    dedupe=10)
+        received = []
+        receiver.handler(received.append)
+        receiver.start()
+        url = 'http://127.0.0.1:%d' % receiver.port
+
+        self.assertEqual(requests.post(url + '/hook', self.body).status_code,
+                         200)
+        self.assertEqual(requests.post(url + '/hook', self.body).status_code,
+                         200)
+        self.assertEqual(requests.post(url + '/other', self.body).status_code,
+                         404)
+        self.assertEqual(requests.post(url + '/hook', 'nope').status_code, 400)
+        self.assertEqual(requests.post(url + '/hook', {
+            'trigger': json.dumps({'triggerId': 'form'})
+        }).status_code, 200)
+        receiver.shutdown()
+
+        self.assertEqual(received, [self.callback,
+                                    {'trigger': {'triggerId': 'form'}}])
+        stats = receiver.stats()
+        self.assertEqual(stats['received'], 3)
+        self.assertEqual(stats['duplicates'], 1)
+        self.assertEqual(stats['dispatched'], 2)
+
+    def test_back_pressure(self):
+        """
+        Test that callbacks are rejected while the queue is full.
+        """
+        receiver = CallbackReceiver(port=0, workers=1, queue_size=1,
+                                    dedupe=10)
+        release = threading.Event()
+        receiver.handler(lambda callback: release.wait())
+
+        bodies = [json.dumps({'n': n}) for n in range(3)]
+        self.assertEqual(receiver.receive(bodies[0]), 200)
+
+        # wait for the worker to take the first callback off the queue
+        while receiver.queue.qsize():
+            release.wait(0.01)
+
+        self.assertEqual(receiver.receive(bodies[1]), 200)
+        self.assertEqual(receiver.receive(bodies[2]), 503)
+        self.assertEqual(receiver.stats()['rejected'], 1)
+
+        # the rejected callback is accepted again once there is room
+        release.set()
+        receiver.queue.join()
+        self.assertEqual(receiver.receive(bodies[2]), 200)
+        receiver.server.server_close()
+
+
+class TagSyncTestCase(TestCase):
+    """
+    Tests for the `TagSync` class.
+    """
+
+    def setUp(self):
+        self.client = Mock()
+        self.sync = TagSync(self.client, 'trigger', max_ids=2)
+
+    def test_plan(self):
+        """
+        Test that objects needing the same change share a request.
+        """
+        current = {
+            'a': set(['trigger:a', 'old']),
+            'b': set(['trigger:b', 'old']),
+            'c': set(['trigger:c', 'old']),
+            'd': set(['trigger:d', 'keep'])
+        }
+        desired = {
+            'a': ['new'],
+            'b': ['new'],
+            'c': ['new'],
+            'd': ['keep'],
+            'e': ['new']
+        }
+        plan = self.sync.plan(desired, current)
+
+        self.assertEqual(self.sync.missing, ['e'])
+        self.assertEqual([u.payload() for u in plan], [
+            {'triggerIds': ['a', 'b'], 'addTags': ['new'],
+             'removeTags': ['old']},
+            {'triggerIds': ['c'], 'addTags': ['new'], 'removeTags': ['old']}
+        ])
+
+    def test_plan_by_tag(self):
+        """
+        Test that a change is grouped by tag when that takes fewer requests.
+        """
+        current = dict((i, set(['a', 'b'])) for i in 'wxyz')
+        desired = {'w': ['a'], 'x': ['b'], 'y': ['a', 'c'], 'z': ['b', 'c']}
+        plan = sorted(self.sync.plan(desired, current), key=str)
+
+        self.assertEqual([str(u) for u in plan], [
+            'trigger/update 2 triggers: +c',
+            'trigger/update 2 triggers: -a',
+            'trigger/update 2 triggers: -b'
+        ])
+
+        # updates of the same trigger are never in flight together
+        lock = threading.Lock()
+        updating = set()
+        overlaps = []
+
+        def request(route, data):
+            ids = set(data['triggerIds'])
+            with lock:
+                if updating & ids:
+                    overlaps.append(ids)
+                updating.update(ids)
+            time.sleep(0.05)
+            with lock:
+                updating.difference_update(ids)
+            return data
+
+        self.client.request.side_effect = request
+        results = self.sync.apply(plan)
+        self.assertEqual(overlaps, [])
+        self.assertEqual(results, [u.payload() for u in plan])
+
+    def test_sync(self):
+        """
+        Test fetching current tags and applying a plan.
+        """
+        self.client.request_stream.return_value = [
+            {'triggerId': 'a', 'tags': ['trigger:a']}]
+
+        plan = self.sync.sync({'a': ['new']}, dry_run=True)
+        self.client.request_stream.assert_called_once_with(
+            'trigger/list', 'triggers', {'triggerIds': ['a']})
+        self.assertEqual(self.client.request.call_count, 0)
+
+        self.sync.apply(plan)
+        self.client.request.assert_called_once_with(
+            'trigger/update', {'triggerIds': ['a'], 'addTags': ['new']})
+
+        self.client.request.side_effect = GeotriggerException()
+        self.assertRaises(GeotriggerException, self.sync.apply, plan)
+        self.assertEqual(len(self.sync.failures), 1)
+
+
+class TriggerAnalyzerTestCase(TestCase):
+    """
+    Tests for the `TriggerAnalyzer` class.
+    """
+
+    def trigger(self, trigger_id, latitude, longitude, distance,
+                url='http://example.com/callback'):
+        return Trigger(trigger_id, 'enter', latitude, longitude, distance,
+                       action={'callbackUrl': url},
+                       tags=['trigger:' + trigger_id, 'hq'])
+
+    def test_analyze(self):
+        """
+        Test detection of duplicate, contained and overlapping fences.
+        """
+        triggers = [
+            self.trigger('a', 34.0562, -117.1956, 100),
+            self.trigger('b', 34.0562, -117.1956, 100),
+            self.trigger('c', 34.0562, -117.1956, 100.5),
+            # 30 meters east of 'a', inside both 'a' and 'e'
+            self.trigger('d', 34.0562, -117.19527, 50),
+            # 20 meters north of 'a', mostly overlapping it
+            self.trigger('e', 34.05638, -117.1956, 100),
+            # same fence, different action
+            self.trigger('f', 34.0562, -117.1956, 100, url='http://other'),
+            # far away
+            self.trigger('g', 45.5165, -122.6764, 100)
+        ]
+        report = TriggerAnalyzer().analyze(triggers)
+
+        self.assertEqual(report.analyzed, 7)
+        found = sorted((f.kind, f.keep, f.redundant) for f in report.findings)
+        self.assertEqual(found, [
+            ('contained', 'a', ['d']),
+            ('contained', 'e', ['d']),
+            ('duplicate', 'a', ['b', 'c']),
+            ('overlap', 'a', ['e'])
+        ])
+        self.assertEqual(report.delete_ids(), ['b', 'c'])
+        self.assertEqual(report.delete_ids(('duplicate', 'contained')),
+                         ['b', 'c', 'd'])
+
+        client = Mock()
+        report.apply(client)
+        client.request.assert_called_once_with(
+            'trigger/delete', {'triggerIds': ['b', 'c']})
+
+    def test_analyze_scale(self):
+        """
+        Test that large sets of distinct fences produce no findings.
+        """
+        triggers = [self.trigger(str(i), 34 + (i // 100) * 0.01,
+                                 -117 + (i % 100) * 0.01, 50 + i % 7)
+                    for i in range(5000)]
+        report = TriggerAnalyzer().analyze(triggers)
+        self.assertEqual(report.findings, [])
+
+    def test_analyze_duplicate_scale(self):
+        """
+        Test that thousands of identical fences are grouped without comparing
+        every pair.
+        """
+        triggers = [self.trigger('%04d' % i, 34.0562, -117.1956, 100)
+                    for i in range(4000)]
+        start = time.time()
+        report = TriggerAnalyzer().analyze(triggers)
+        self.assertLess(time.time() - start, 5)
+
+        self.assertEqual(len(report.findings), 1)
+        self.assertEqual(report.findings[0].keep, '0000')
+        self.assertEqual(len(report.delete_ids()), 3999)
+
+
+class CommandLineTestCase(TestCase):
+    """
+    Tests for the `geotrigger` command line tool.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = TokenCache(os.path.join(self.tmp, 'gt', 'tokens.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_token_cache(self):
+        """
+        Test that cached device tokens are reused instead of registering.
+        """
+        device = GeotriggerDevice('abc', 'dev', 'token', 'refresh', 1000)
+        self.cache.save(device)
+        self.assertEqual(os.stat(self.cache.path).st_mode & 0777, 0600)
+
+        with patch.object(GeotriggerDevice, 'register') as register:
+            session = self.cache.session('abc')
+            self.assertEqual(register.call_count, 0)
+
+        self.assertEqual(session.device_id, 'dev')
+        self.assertEqual(session.access_token, 'token')
+        self.assertEqual(session.refresh_token, 'refresh')
+        self.assertTrue(
+            abs((session.expires_at - device.expires_at).total_seconds()) < 2)
+
+        # Applications are cached separately and only reused while valid.
+        self.cache.save(GeotriggerApplication('abc', 'secret', 'app', 10))
+        with patch.object(GeotriggerApplication, 'refresh') as refresh:
+            session = self.cache.session('abc', 'secret')
+            self.assertEqual(refresh.call_count, 1)
+        self.assertEqual(self.cache.session('abc').access_token, 'token')
+
+    def test_pipeline(self):
+        """
+        Test that responses are written in input order, one per line.
+        """
+        client = Mock()
+
+        def request(route, data, deadline=None):
+            if route == 'fail':
+                raise GeotriggerException('failed')
+            time.sleep(data['sleep'])
+            return {'route': route}
+        client.request.side_effect = request
+
+        lines = [json.dumps({'id': i, 'route': 'r{}'.format(i),
+                             'data': {'sleep': 0.01 * (5 - i)}})
+                 for i in range(5)]
+        lines.insert(2, '{"route": "fail"}')
+        lines.insert(3, '')
+        out = StringIO()
+
+        errors = pipeline(client, lines, out, concurrency=3)
+        responses = [json.loads(l) for l in out.getvalue().splitlines()]
+
+        self.assertEqual(errors, 1)
+        self.assertEqual(len(responses), 6)
+        self.assertEqual(responses[2], {'route': 'fail', 'error': 'failed'})
+        del responses[2]
+        self.assertEqual(responses, [
+            {'id': i, 'route': 'r{}'.format(i),
+             'response': {'route': 'r{}'.format(i)}} for i in range(5)])
+
+        self.assertRaises(ValueError, pipeline, client, lines, out, 0)
+
+    def test_arguments(self):
+        """
+        Test that invalid options are rejected.
+        """
+        with patch('sys.stderr', StringIO()):
+            self.assertRaises(SystemExit, main,
+                              ['--client-id', 'abc', '--concurrency', '0'])
+
+
+class ParallelMapTestCase(TestCase):
+    """
+    Tests for `parallel_map`.
+    """
+
+    def test_parallel_map(self):
+        """
+        Test that results and exceptions are returned in order.
+        """
+        error = ValueError()
+
+        def func(i):
+            time.sleep(0.01 * (5 - i))
+            if i == 2:
+                raise error
+            return i * i
+
+        self.assertEqual(parallel_map(func, range(5), 3),
+                         [0, 1, error, 9, 16])
+        self.assertEqual(parallel_map(func, [], 3), [])
+
+
+class DevicePoolTestCase(TestCase):
+    """
+    Tests for the `DevicePool` class.
+    """
+
+    def setUp(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+        def register(device):
+            with self.lock:
+                self.count += 1
+                n = self.count
+            if n == 3:
+                raise GeotriggerException('failed')
+            return {'device_id': 'dev{}'.format(n), 'access_token': 'token',
+                    'refresh_token': 'refresh', 'expires_in': 1000}
+
+        patcher = patch.object(GeotriggerDevice, 'register', autospec=True,
+                               side_effect=register)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pool = DevicePool('abc', workers=4)
+
+    def test_fill(self):
+        """
+        Test that devices are registered in parallel up to the pool size.
+        """
+        self.assertEqual(self.pool.fill(5), 4)
+        self.assertEqual(len(self.pool.failures), 1)
+        self.assertEqual(self.pool.fill(5), 1)
+        self.assertEqual(self.pool.fill(5), 0)
+        self.assertEqual(len(set(d.device_id for d in self.pool.devices)), 5)
+
+    def test_lease(self):
+        """
+        Test leasing devices, waiting for a returned device and saturation.
+        """
+        self.assertRaises(GeotriggerException, self.pool.lease)
+        self.pool.fill(2)
+
+        first = self.pool.lease()
+        with self.pool.client() as gt:
+            self.assertIsInstance(gt, GeotriggerClient)
+            self.assertRaises(GeotriggerException, self.pool.lease, 0.01)
+            timer = threading.Timer(0.05, self.pool.release, [first])
+            timer.start()
+            self.assertIs(self.pool.lease(1), first)
+
+        # only leased devices can be released, once
+        self.assertRaises(ValueError, self.pool.release, self.pool.devices[1])
+        self.assertRaises(ValueError, self.pool.release, Mock())
+
+        stats = self.pool.stats()
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(stats['leased'], 1)
+        self.assertEqual(stats['max_leased'], 2)
+        self.assertEqual(stats['utilization'], 0.5)
+        self.assertEqual(stats['leases'], 3)
+        self.assertEqual(stats['waits'], 2)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertTrue(stats['wait_time'] > 0.04)
+
+    def test_refresh(self):
+        """
+        Test that only idle devices about to expire are refreshed.
+        """
+        self.pool.fill(4)
+        soon, leased, later = self.pool.devices
+        soon.set_expires(100)
+        leased.set_expires(100)
+        self.assertIs(self.pool.lease(), soon)
+        self.assertIs(self.pool.lease(), leased)
+        self.pool.release(soon)
+
+        def refresh(device):
+            stats = self.pool.stats()
+            self.assertEqual(stats['refreshing'], 1)
+            self.assertEqual(stats['leased'], 1)
+            self.assertEqual(stats['idle'], 1)
+
+        with patch.object(GeotriggerDevice, 'refresh', autospec=True,
+                          side_effect=refresh) as mock_refresh:
+            self.assertEqual(self.pool.refresh_idle(), 1)
+            self.assertEqual(mock_refresh.call_count, 1)
+        stats = self.pool.stats()
+        self.assertEqual(stats['idle'], 2)
+        self.assertEqual(stats['refreshing'], 0)
+        self.assertEqual(stats['refreshed'], 1)
+        self.assertRaises(ValueError, self.pool.release, soon)
+        self.pool.release(leased)
+
+    def test_save(self):
+        """
+        Test that saved devices are loaded without registering.
+        """
+        self.pool.fill(2)
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        self.pool.save(path)
+
+        pool = DevicePool('abc')
+        self.assertEqual(pool.load(path), 2)
+        self.assertEqual(self.count, 2)
+        self.assertEqual([d.device_id for d in pool.devices],
+                         [d.device_id for d in self.pool.devices])
+        self.assertTrue(abs((pool.devices[0].expires_at -
+                             self.pool.devices[0].expires_at)
+                            .total_seconds()) < 2)
+
+
+class ProfilerTestCase(TestCase):
+    """
+    Tests for the `Profiler` class.
+    """
+
+    def setUp(self):
+        self.session = GeotriggerSession('test_client_id', 'test_client_secret',
+                                         'test_access_token', expires_in=800)
+        self.profiler = Profiler(sample_rate=1, slowest=2)
+        self.session.profiler = self.profiler
+
+    @patch('geotrigger.session.http')
+    def test_profile(self, mock_http):
+        """
+        Test that sampled requests record the time spent in each phase.
+        """
+        res = mock_http.return_value.post.return_value
+        res.status_code = 200
+        res.json.side_effect = [{'ok': 1}, {'ok': 2},
+                                {'error': {'message': 'failed'}}]
+
+        self.session.geotrigger_request('trigger/list', {'tags': 'a'})
+        self.session.geotrigger_request('device/list')
+        self.assertRaises(GeotriggerException,
+                          self.session.geotrigger_request, 'trigger/list')
+
+        self.assertEqual(mock_http.return_value.post.call_count, 3)
+        self.assertIsNone(self.profiler.current())
+        self.assertEqual(self.profiler.sampled, 3)
+        self.assertEqual(self.profiler.failed, 1)
+
+        slowest = self.profiler.slowest()
+        self.assertEqual(len(slowest), 2)
+        self.assertGreaterEqual(slowest[0].elapsed, slowest[1].elapsed)
+        for profile in slowest:
+            self.assertAlmostEqual(sum(profile.phases.values()),
+                                   profile.elapsed, places=6)
+            self.assertTrue(set(['serialize', 'refresh', 'headers', 'wait',
+                                 'decode']) <= set(profile.phases))
+
+        summary = self.profiler.summary()
+        self.assertGreater(summary['error']['total'], 0)
+        self.assertEqual(summary['connect']['total'], 0)
+
+        out = StringIO()
+        self.profiler.dump(1, out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0].split(' (')[0], 'Sampled 3 requests')
+        self.assertEqual(lines[-2], 'Slowest requests:')
+        self.assertIn(slowest[0].route, lines[-1])
+
+    @patch('geotrigger.session.http')
+    def test_sampling(self, mock_http):
+        """
+        Test that requests that are not sampled are not profiled.
+        """
+        res = mock_http.return_value.post.return_value
+        res.status_code = 200
+        res.json.return_value = {}
+
+        self.profiler.sample_rate = 0
+        self.session.geotrigger_request('trigger/list')
+        self.assertEqual(mock_http.return_value.post.call_count, 1)
+        self.assertEqual(self.profiler.sampled, 0)
+
+        self.assertRaises(ValueError, Profiler, 1.5)
+
+    def test_connection(self):
+        """
+        Test that connecting and sending are timed on the shared connections,
+        only for sampled requests.
+        """
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                body = '{"ok": true}'
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.addCleanup(server.server_close)
+        url = 'http://127.0.0.1:{}/'.format(server.server_port)
+
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        profile = self.profiler.start('local')
+        self.assertEqual(self.session.post(url, '{}', {}), {'ok': True})
+        self.profiler.stop(profile)
+        thread.join()
+
+        self.assertEqual(sorted(profile.phases),
+                         ['connect', 'decode', 'send', 'wait'])
+
+        phases = dict(profile.phases)
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        self.assertEqual(self.session.post(url, '{}', {}), {'ok': True})
+        thread.join()
+        self.assertEqual(profile.phases, phases)
+
+    @patch('geotrigger.session._http', None)
+    @patch('geotrigger.session.requests', None)
+    def test_connection_error(self):
+        """
+        Test that the first request of a process, if sampled, raises its own
+        connection error.
+        """
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        url = 'http://127.0.0.1:{}/'.format(sock.getsockname()[1])
+        sock.close()
+
+        with patch('geotrigger.session.GEOTRIGGER_BASE_URL', url):
+            self.assertRaises(requests.exceptions.ConnectionError,
+                              self.session.geotrigger_request, 'trigger/list')
+        self.assertEqual(self.profiler.failed, 1)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file